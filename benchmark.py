@@ -0,0 +1,334 @@
+# Benchmark harness for the upscaling pipeline
+#
+# Usage:
+#   python benchmark.py run [--out bench.json] [--sizes 128,256] [--scales 2,3,4] [--repeats 5]
+#                           [--kinds model,realesrgan,resize,encode] [--realesrgan-path PATH]
+#   python benchmark.py compare baseline.json candidate.json [--threshold 0.15]
+#
+# `run` covers every MODELS entry, each Real-ESRGAN backend (single and batched invocations),
+# resize_image and every encoder preset over a matrix of input sizes and scales. Every case runs in a fresh Python
+# process so cold latency and peak RSS aren't skewed by earlier cases. Quality is PSNR/SSIM
+# against a synthetic high-res reference that the input is downscaled from.
+#
+# `compare` lines up two runs by case id and exits with status 1 if anything regressed.
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Real-ESRGAN models with the scales they run at natively
+REALESRGAN_CASES = [('realesrgan-x4plus', 4), ('realesrgan-x4plus-anime', 4)] + \
+                   [(f'realesr-animevideov3-x{scale}', scale) for scale in (2, 3, 4)]
+
+# Jobs per batched Real-ESRGAN invocation
+REALESRGAN_BATCH = 4
+
+# Output formats for the encoder cases, with the quality used for the lossy ones
+ENCODE_CASES = [('jpg', 90), ('png', None), ('webp', 90)]
+
+# compare: metric -> (higher is better, threshold); None means use --threshold as a relative change
+METRICS = {
+    'coldMs': (False, None),
+    'warmMs': (False, None),
+    'throughput': (True, None),
+    'peakRssMb': (False, None),
+    'bytes': (False, None),
+    'psnr': (True, 0.1),    # dB
+    'ssim': (True, 0.002),
+}
+
+# ============== TEST IMAGES ==============
+
+def reference_image(width, height):
+    """Deterministic high-res image with gradients, text, hard edges and fine lines"""
+    y, x = np.mgrid[0:height, 0:width]
+    img = np.dstack([50 + 100 * y / height, 30 + 100 * x / width, np.full((height, width), 80.0)]).astype(np.uint8)
+    unit = min(width, height) / 400
+    cv2.putText(img, "HELLO", (int(50 * unit), int(200 * unit)), cv2.FONT_HERSHEY_SIMPLEX, 3 * unit, (255, 255, 255), max(1, int(4 * unit)))
+    cv2.putText(img, "World!", (int(80 * unit), int(320 * unit)), cv2.FONT_HERSHEY_SIMPLEX, 2.5 * unit, (200, 200, 255), max(1, int(3 * unit)))
+    cv2.rectangle(img, (int(300 * unit), int(50 * unit)), (int(380 * unit), int(130 * unit)), (0, 200, 255), -1)
+    cv2.circle(img, (int(340 * unit), int(300 * unit)), int(50 * unit), (255, 100, 100), -1)
+    for i in range(int(10 * unit), int(100 * unit), max(2, int(10 * unit))):
+        cv2.line(img, (int(10 * unit), i), (int(100 * unit), i), (255, 255, 255), 1)
+    return img
+
+def test_pair(width, height, scale):
+    """(low-res input, reference it was downscaled from)"""
+    reference = reference_image(width * scale, height * scale)
+    return cv2.resize(reference, (width, height), interpolation=cv2.INTER_AREA), reference
+
+def ssim(a, b):
+    """Mean SSIM on luma with the usual 11x11 Gaussian window"""
+    a = cv2.cvtColor(a, cv2.COLOR_BGR2GRAY).astype(np.float64)
+    b = cv2.cvtColor(b, cv2.COLOR_BGR2GRAY).astype(np.float64)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    blur = lambda img: cv2.GaussianBlur(img, (11, 11), 1.5)
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a * mu_a
+    var_b = blur(b * b) - mu_b * mu_b
+    cov = blur(a * b) - mu_a * mu_b
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return float(ssim_map.mean())
+
+def quality(result, reference):
+    if result is None or result.shape != reference.shape:
+        return {"psnr": None, "ssim": None}
+    return {"psnr": round(cv2.PSNR(result, reference), 3), "ssim": round(ssim(result, reference), 5)}
+
+def timings(run, repeats):
+    """Cold time of the first call, then warm times of `repeats` more"""
+    start = time.perf_counter()
+    result = run()
+    cold = (time.perf_counter() - start) * 1000
+    warm = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = run()
+        warm.append((time.perf_counter() - start) * 1000)
+    return result, cold, sorted(warm)
+
+def summarize(cold, warm, images_per_run=1):
+    return {
+        "coldMs": round(cold, 2),
+        "warmMs": round(warm[len(warm) // 2], 2),
+        "warmP90Ms": round(warm[min(len(warm) - 1, int(len(warm) * 0.9))], 2),
+        "throughput": round(images_per_run * len(warm) * 1000 / sum(warm), 3) if sum(warm) else None,
+    }
+
+# ============== CASES ==============
+
+def run_model_case(case):
+    """One MODELS entry through the same path the service uses (registry + upsample_with_model)"""
+    import upscale_script
+    key = case['target']
+    if upscale_script.get_model_path(key)[0] is None:
+        return {"skipped": f"{upscale_script.MODELS[key]['file']} not found"}
+    image, reference = test_pair(case['width'], case['height'], case['scale'])
+    result, cold, warm = timings(lambda: upscale_script.upsample_with_model(key, image), case['repeats'])
+    return {**summarize(cold, warm), **quality(result, reference)}
+
+def run_realesrgan_case(case, work_dir):
+    """One Real-ESRGAN model through a single or batched RealEsrganBackend"""
+    import upscale_script
+    batched = case['backend'] == 'batched'
+    backend = upscale_script.RealEsrganBackend(case.get('executable'), window_ms=50 if batched else 0,
+                                               max_batch=REALESRGAN_BATCH)
+    if not os.path.exists(backend.path):
+        return {"skipped": f"Real-ESRGAN not found at {backend.path}"}
+    image, reference = test_pair(case['width'], case['height'], case['scale'])
+    input_path = os.path.join(work_dir, 'input.png')
+    cv2.imwrite(input_path, image)
+    jobs = REALESRGAN_BATCH if batched else 1
+    runs = iter(range(case['repeats'] + 1))
+
+    def run():
+        # Fresh output names each run, like the service (overwriting can cost more than the write)
+        run_index = next(runs)
+        outputs = [os.path.join(work_dir, f'output_{run_index}_{i}.png') for i in range(jobs)]
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            ok = list(pool.map(lambda out: backend.run(input_path, out, case['scale'], case['target']), outputs))
+        return cv2.imread(outputs[0]) if all(ok) else None
+
+    result, cold, warm = timings(run, case['repeats'])
+    if result is None:
+        return {"skipped": "Real-ESRGAN failed"}
+    return {**summarize(cold, warm, jobs), **quality(result, reference), "invocations": backend.stats()['invocations']}
+
+def run_resize_case(case, work_dir):
+    """resize_image end to end (decode, resize, encode) at case['percentage']"""
+    import upscale_script
+    scale = case['scale']
+    image, reference = test_pair(case['width'], case['height'], scale)
+    input_path = os.path.join(work_dir, 'input.png')
+    if case['percentage'] > 100:
+        cv2.imwrite(input_path, image)
+    else:
+        cv2.imwrite(input_path, reference)
+    options = {"resizeType": "percentage", "percentage": case['percentage']}
+    output_paths = iter(os.path.join(work_dir, f'output_{i}.png') for i in range(case['repeats'] + 1))
+
+    def run():
+        output_path = next(output_paths)
+        upscale_script.resize_image(input_path, output_path, options)
+        return output_path
+
+    output_path, cold, warm = timings(run, case['repeats'])
+    # Only enlarging has a ground truth to compare against
+    result = cv2.imread(output_path) if case['percentage'] > 100 else None
+    return {**summarize(cold, warm), **quality(result, reference)}
+
+def run_encode_case(case):
+    """encode_image for one format and preset, on a reference the size of a `scale`x output"""
+    import upscale_script
+    reference = reference_image(case['width'] * case['scale'], case['height'] * case['scale'])
+    encode = lambda: upscale_script.encode_image(reference, '.' + case['format'], case['quality'], case['preset'])
+    (encoded, stats), cold, warm = timings(encode, case['repeats'])
+    return {**summarize(cold, warm), **quality(cv2.imdecode(encoded, cv2.IMREAD_COLOR), reference),
+            "bytes": stats['bytes']}
+
+def run_case(case):
+    """Entry point for the per-case child process"""
+    sys.path.insert(0, HERE)
+    os.chdir(HERE)  # MODELS paths are relative to the repo root
+    with tempfile.TemporaryDirectory() as work_dir:
+        if case['kind'] == 'model':
+            metrics = run_model_case(case)
+        elif case['kind'] == 'realesrgan':
+            metrics = run_realesrgan_case(case, work_dir)
+        elif case['kind'] == 'encode':
+            metrics = run_encode_case(case)
+        else:
+            metrics = run_resize_case(case, work_dir)
+    if 'skipped' not in metrics:
+        import upscale_script
+        metrics['peakRssMb'] = upscale_script.peak_rss_mb(include_children=True)
+    return metrics
+
+def build_cases(opts):
+    import upscale_script
+    sizes = [tuple(int(v) for v in (size.split('x') * 2)[:2]) for size in opts.sizes.split(',')]
+    scales = [int(scale) for scale in opts.scales.split(',')]
+    kinds = opts.kinds.split(',')
+    cases = []
+    for width, height in sizes:
+        base = {"width": width, "height": height, "repeats": opts.repeats}
+        if 'model' in kinds:
+            for key, config in upscale_script.MODELS.items():
+                if config['scale'] in scales:
+                    cases.append({**base, "kind": "model", "target": key, "scale": config['scale']})
+        if 'realesrgan' in kinds:
+            for model_name, scale in REALESRGAN_CASES:
+                if scale in scales:
+                    for backend in ('single', 'batched'):
+                        cases.append({**base, "kind": "realesrgan", "target": model_name, "scale": scale,
+                                      "backend": backend, "executable": opts.realesrgan_path})
+        if 'resize' in kinds:
+            for scale in scales:
+                for percentage in (100 * scale, 100 / scale):
+                    cases.append({**base, "kind": "resize", "target": f"{percentage:g}%", "scale": scale,
+                                  "percentage": percentage})
+        if 'encode' in kinds:
+            for scale in scales:
+                for image_format, quality in ENCODE_CASES:
+                    for preset in upscale_script.ENCODE_PRESETS:
+                        cases.append({**base, "kind": "encode", "target": f"{image_format}-{preset}", "scale": scale,
+                                      "format": image_format, "quality": quality, "preset": preset})
+    for case in cases:
+        case['id'] = ":".join(str(part) for part in (
+            case['kind'], case['target'], case.get('backend', ''), f"{case['width']}x{case['height']}", f"{case['scale']}x"))
+    return cases
+
+# ============== COMMANDS ==============
+
+def run(opts):
+    cases = build_cases(opts)
+    results = []
+    for index, case in enumerate(cases, 1):
+        print(f"[{index}/{len(cases)}] {case['id']}", file=sys.stderr)
+        try:
+            child = subprocess.run([sys.executable, os.path.abspath(__file__), 'case', json.dumps(case)],
+                                   capture_output=True, text=True, timeout=opts.timeout, cwd=HERE)
+            if child.returncode != 0:
+                metrics = {"error": child.stderr.strip().splitlines()[-1] if child.stderr.strip() else f"exit {child.returncode}"}
+            else:
+                metrics = json.loads(child.stdout.strip().splitlines()[-1])
+        except subprocess.TimeoutExpired:
+            metrics = {"error": f"timed out after {opts.timeout}s"}
+        entry = {key: value for key, value in case.items() if key not in ('repeats', 'executable')}
+        results.append({**entry, **metrics})
+        summary = metrics.get('skipped') or metrics.get('error') or \
+            f"warm {metrics['warmMs']}ms, cold {metrics['coldMs']}ms, PSNR {metrics['psnr']}, RSS {metrics['peakRssMb']}MB" + \
+            (f", {metrics['bytes']} bytes" if 'bytes' in metrics else "")
+        print(f"    {summary}", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "host": platform.node(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "cpuCount": os.cpu_count(),
+            "repeats": opts.repeats,
+        },
+        "results": results,
+    }
+    with open(opts.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {opts.out}", file=sys.stderr)
+    return 0
+
+def compare(opts):
+    with open(opts.baseline) as f:
+        baseline = {entry['id']: entry for entry in json.load(f)['results']}
+    with open(opts.candidate) as f:
+        candidate = {entry['id']: entry for entry in json.load(f)['results']}
+
+    regressions = 0
+    for case_id in sorted(baseline.keys() & candidate.keys()):
+        before, after = baseline[case_id], candidate[case_id]
+        for metric, (higher_is_better, absolute) in METRICS.items():
+            old, new = before.get(metric), after.get(metric)
+            if old is None or new is None:
+                continue
+            change = new - old if higher_is_better else old - new  # Negative means worse
+            if absolute is not None:
+                worse = change < -absolute
+                detail = f"{old} -> {new}"
+            else:
+                worse = old and change / old < -opts.threshold
+                detail = f"{old} -> {new} ({(new - old) / old:+.1%})" if old else f"{old} -> {new}"
+            if worse:
+                regressions += 1
+                print(f"❌ {case_id} {metric}: {detail}")
+            elif opts.verbose:
+                print(f"✅ {case_id} {metric}: {detail}")
+
+    for case_id in sorted(baseline.keys() - candidate.keys()):
+        print(f"⚠️  {case_id} missing from candidate")
+    print(f"{regressions} regression(s) across {len(baseline.keys() & candidate.keys())} shared case(s)")
+    return 1 if regressions else 0
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Run the benchmark matrix and write JSON')
+    run_parser.add_argument('--out', default='bench.json', help='Where to write results')
+    run_parser.add_argument('--sizes', default='128,256', help='Comma-separated input sizes (N or WxH)')
+    run_parser.add_argument('--scales', default='2,3,4', help='Comma-separated scales')
+    run_parser.add_argument('--repeats', type=int, default=5, help='Warm runs per case')
+    run_parser.add_argument('--kinds', default='model,realesrgan,resize,encode', help='Which case kinds to run')
+    run_parser.add_argument('--realesrgan-path', help='Real-ESRGAN executable (default: REALESRGAN_PATH)')
+    run_parser.add_argument('--timeout', type=int, default=900, help='Seconds allowed per case')
+
+    compare_parser = commands.add_parser('compare', help='Flag regressions between two runs')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=0.15,
+                                help='Relative slowdown (or RSS/throughput change) that counts as a regression')
+    compare_parser.add_argument('--verbose', action='store_true', help='Also list metrics that held up')
+
+    case_parser = commands.add_parser('case')  # Internal: one case in a fresh process
+    case_parser.add_argument('spec')
+
+    opts = parser.parse_args(argv[1:])
+    if opts.command == 'case':
+        print(json.dumps(run_case(json.loads(opts.spec))))
+        return 0
+    if opts.command == 'compare':
+        return compare(opts)
+    return run(opts)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
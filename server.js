@@ -39,6 +39,9 @@ const rateLimit = require('express-rate-limit');
 
 const app = express();
 const PORT = process.env.PORT || 5000;
+
+// Encoder presets upscale_script.py accepts (encode speed vs output size)
+const ENCODE_PRESETS = ['fast', 'balanced', 'smallest'];
 const isProduction = process.env.NODE_ENV === 'production';
 
 // ============== SERVER-SIDE RATE LIMITING ==============
@@ -206,10 +209,8 @@ app.post('/get-dimensions', processLimiter, upload.single('image'), (req, res) =
 
     const inputPath = req.file.path;
     
-    const pythonProcess = spawn('python', [
-        '-c',
-        `import cv2; import json; img = cv2.imread("${inputPath.replace(/\\/g, '\\\\')}"); h, w = img.shape[:2]; print(json.dumps({"width": w, "height": h}))`
-    ]);
+    // Header-only probe (no pixel decode); the path is passed as an argument, not code
+    const pythonProcess = spawn('python', ['upscale_script.py', '--probe', inputPath]);
 
     let output = '';
     pythonProcess.stdout.on('data', (data) => {
@@ -229,8 +230,11 @@ app.post('/get-dimensions', processLimiter, upload.single('image'), (req, res) =
         }
         
         try {
-            const dimensions = JSON.parse(output.trim());
-            res.json(dimensions);
+            const [probe] = JSON.parse(output.trim());
+            if (!probe || probe.error) {
+                return res.status(500).send('Failed to get dimensions.');
+            }
+            res.json({ width: probe.width, height: probe.height });
         } catch (e) {
             res.status(500).send('Failed to parse dimensions.');
         }
@@ -254,6 +258,9 @@ app.post('/upscale', processLimiter, queueMiddleware, optionalAuth, upload.singl
     const modelType = req.body.modelType || 'realesrgan-fast';
     const validModels = ['realesrgan', 'realesrgan-fast', 'realesrgan-anime', 'edsr', 'fsrcnn', 'espcn'];
     const finalModelType = validModels.includes(modelType) ? modelType : 'realesrgan-fast';
+    const encodePreset = ENCODE_PRESETS.includes(req.body.encodePreset) ? req.body.encodePreset : 'balanced';
+    // Hybrid tiling: flat EDSR tiles go through Lanczos (multipart fields arrive as strings)
+    const hybrid = req.body.hybrid === true || req.body.hybrid === 'true';
     
     const outputPath = `processed/${req.file.filename}_upscaled_${finalModelType}_${finalScale}x.jpg`;
 
@@ -373,7 +380,9 @@ app.post('/upscale', processLimiter, queueMiddleware, optionalAuth, upload.singl
         JSON.stringify({ 
             model: `${finalScale}x`, 
             modelType: finalModelType,
-            tier: subscriptionTier 
+            tier: subscriptionTier,
+            encodePreset,
+            hybrid
         })
     ]);
 
@@ -469,7 +478,8 @@ app.post('/resize', processLimiter, queueMiddleware, optionalAuth, upload.single
         width: parseInt(req.body.width) || 800,
         height: parseInt(req.body.height) || 600,
         maintainAspect: req.body.maintainAspect !== 'false',
-        quality: parseInt(req.body.quality) || 90
+        quality: parseInt(req.body.quality) || 90,
+        encodePreset: ENCODE_PRESETS.includes(req.body.encodePreset) ? req.body.encodePreset : 'balanced'
     };
 
     console.log('Resize options:', options);
@@ -1,4 +1,5 @@
 # Real-world test: Compare AI upscaling vs simple resize
+# (for PSNR/SSIM and latency across sizes and scales, use `python benchmark.py run`)
 import cv2
 from cv2 import dnn_superres
 import numpy as np
@@ -1,4 +1,5 @@
 # Test script to verify AI upscaling models are working
+# (timings here are a smoke check; use `python benchmark.py run` for numbers to track)
 import cv2
 from cv2 import dnn_superres
 import numpy as np
@@ -115,7 +116,268 @@ for name, filename in files_2x:
             else:
                 print(f"{name}: ✅ Different from bicubic (mean diff: {mean_diff:.2f}, max: {max_diff})")
 
+# Check the batched cv2.dnn engine against dnn_superres
 print()
+print("=" * 60)
+print("BATCHED ENGINE PARITY (vs dnn_superres)")
+print("=" * 60)
+
+from upscale_script import BatchedSuperRes
+
+# dnn_superres resamples Cr/Cb slightly differently, so allow a couple of levels
+PARITY_TOLERANCE = 2
+
+batch = [create_test_image(), cv2.flip(create_test_image(), 1), cv2.flip(create_test_image(), 0)]
+for model_name, model_file, scale in models:
+    print(f"Testing {model_name.upper()} x{scale}:")
+    if not os.path.exists(model_file):
+        print(f"  ❌ {model_file} not found!")
+        print()
+        continue
+    
+    sr = dnn_superres.DnnSuperResImpl_create()
+    sr.readModel(model_file)
+    sr.setModel(model_name, scale)
+    expected = [sr.upsample(img) for img in batch]
+    
+    engine = BatchedSuperRes(f"{model_name}_{scale}x")
+    start = time.time()
+    results = engine.upsample_batch(batch)
+    elapsed = time.time() - start
+    
+    max_diff = max(int(cv2.absdiff(e, r).max()) for e, r in zip(expected, results))
+    if all(e.shape == r.shape for e, r in zip(expected, results)) and max_diff <= PARITY_TOLERANCE:
+        print(f"  ✅ Batch of {len(batch)} matches (max diff: {max_diff}), Time: {elapsed:.3f}s")
+    else:
+        print(f"  ❌ Batched output differs (max diff: {max_diff})")
+    print()
+
+print("=" * 60)
+print("REAL-ESRGAN BACKEND (stub executable)")
+print("=" * 60)
+
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from upscale_script import RealEsrganBackend
+
+# Stands in for realesrgan-ncnn-vulkan: same arguments, bicubic instead of the network
+STUB = f"""#!{sys.executable}
+import os, sys, cv2
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+src, dst, scale = args['-i'], args['-o'], int(args['-s'])
+pairs = [(src, dst)]
+if os.path.isdir(src):
+    pairs = [(os.path.join(src, name), os.path.join(dst, os.path.splitext(name)[0] + '.' + args.get('-f', 'png')))
+             for name in os.listdir(src)]
+for src, dst in pairs:
+    img = cv2.imread(src)
+    cv2.imwrite(dst, cv2.resize(img, (img.shape[1] * scale, img.shape[0] * scale), interpolation=cv2.INTER_CUBIC))
+"""
+
+if os.name == 'nt':
+    print("  Skipped (stub needs a POSIX shebang)")
+else:
+    with tempfile.TemporaryDirectory() as work_dir:
+        stub_path = os.path.join(work_dir, 'realesrgan-stub')
+        with open(stub_path, 'w') as f:
+            f.write(STUB)
+        os.chmod(stub_path, 0o755)
+        input_path = os.path.join(work_dir, 'input.png')
+        cv2.imwrite(input_path, create_test_image())
+        
+        backend = RealEsrganBackend(stub_path, window_ms=200)
+        outputs = [os.path.join(work_dir, f'out_{i}.png') for i in range(4)]
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=len(outputs)) as pool:
+            ok = list(pool.map(lambda out: backend.run(input_path, out, 4, 'realesrgan-x4plus'), outputs))
+        elapsed = time.time() - start
+        
+        stats = backend.stats()
+        shapes = [cv2.imread(out).shape[:2] for out in outputs if os.path.exists(out)]
+        if all(ok) and shapes == [(400, 400)] * len(outputs) and stats['invocations'] == 1:
+            print(f"  ✅ {len(outputs)} jobs in 1 invocation, Time: {elapsed:.3f}s")
+        else:
+            print(f"  ❌ Batching failed (results: {ok}, invocations: {stats['invocations']})")
+print()
+
+print("=" * 60)
+print("ENCODER PRESETS")
+print("=" * 60)
+
+from upscale_script import ENCODE_PRESETS, encode_image
+
+image = cv2.resize(create_test_image(), (400, 400), interpolation=cv2.INTER_CUBIC)
+for ext, quality in (('.jpg', 90), ('.png', None), ('.webp', 90)):
+    sizes = {}
+    for preset in ENCODE_PRESETS:
+        encoded, stats = encode_image(image, ext, quality, preset)
+        decoded = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+        sizes[preset] = stats['bytes']
+        if decoded is None or decoded.shape != image.shape or (ext == '.png' and not np.array_equal(decoded, image)):
+            print(f"  ❌ {ext} {preset}: output doesn't decode back to the image")
+    if sizes['smallest'] <= sizes['balanced'] <= sizes['fast']:
+        print(f"  ✅ {ext}: " + ", ".join(f"{preset} {size} bytes" for preset, size in sizes.items()))
+    else:
+        print(f"  ❌ {ext}: presets out of order ({sizes})")
+print()
+
+print("=" * 60)
+print("TILED PATHS (vs serial)")
+print("=" * 60)
+
+from upscale_script import (MODELS, MODEL_REGISTRY, TileBlender, TileRunner, crop_tiles, get_model_path,
+                            tile_complexity, tile_grid, tile_key)
+
+TILE_SIZE, TILE_OVERLAP = 48, 8
+
+def tiled(model_key, image, scale, **runner_args):
+    """Blend every tile TileRunner hands back, as upscale_with_tiling does"""
+    h, w = image.shape[:2]
+    blender = TileBlender(h, w, scale, TILE_OVERLAP, image.shape[2])
+    with TileRunner(model_key, **runner_args) as runner:
+        for box, upscaled_tile in runner.run(image, tile_grid(h, w, TILE_SIZE, TILE_OVERLAP)):
+            blender.add(box, upscaled_tile)
+    return blender.result()
+
+def tiled_by_hand(model_key, image, scale, flat_threshold=None):
+    """Every tile through the network one at a time (or Lanczos if flat), no pool and no dedup"""
+    h, w = image.shape[:2]
+    boxes = tile_grid(h, w, TILE_SIZE, TILE_OVERLAP)
+    blender = TileBlender(h, w, scale, TILE_OVERLAP, image.shape[2])
+    with MODEL_REGISTRY.acquire(model_key) as sr:
+        for box, tile in zip(boxes, crop_tiles(image, boxes)):
+            if flat_threshold is not None and tile_complexity(tile) <= flat_threshold:
+                upscaled_tile = cv2.resize(tile, (tile.shape[1] * scale, tile.shape[0] * scale),
+                                           interpolation=cv2.INTER_LANCZOS4)
+            else:
+                upscaled_tile = sr.upsample(tile)
+            blender.add(box, upscaled_tile)
+    return blender.result()
+
+# Detailed left half, flat right half, and a repeated pattern so some tiles are pixel-identical
+tile_input = np.full((200, 200, 3), 128, dtype=np.uint8)
+tile_input[:, :100] = np.tile(create_test_image()[:40, :40], (5, 3, 1))[:, :100]
+
+for model_key, scale in (('fsrcnn_2x', 2), ('espcn_3x', 3)):
+    print(f"Testing {model_key}:")
+    if get_model_path(model_key)[0] is None:
+        print(f"  ❌ {MODELS[model_key]['file']} not found!")
+        print()
+        continue
+    serial = tiled(model_key, tile_input, scale)
+    
+    boxes = tile_grid(200, 200, TILE_SIZE, TILE_OVERLAP)
+    unique = len({tile_key(model_key, 'superres', 'fp32', tile) for tile in crop_tiles(tile_input, boxes)})
+    if np.array_equal(serial, tiled_by_hand(model_key, tile_input, scale)) and unique < len(boxes):
+        print(f"  ✅ Dedup ({len(boxes) - unique} of {len(boxes)} tiles reused) matches per-tile inference")
+    else:
+        print(f"  ❌ Dedup output differs from per-tile inference ({unique} unique of {len(boxes)})")
+    
+    # Batched tiles go through BatchedSuperRes, which is only within PARITY_TOLERANCE of dnn_superres,
+    # so its pools are held to its own serial output
+    batched_serial = tiled(model_key, tile_input, scale, batch_size=3)
+    for label, expected, runner_args in (('thread pool', serial, {'workers': 2}),
+                                         ('process pool', serial, {'workers': 2, 'pool': 'process'}),
+                                         ('batched thread pool', batched_serial, {'workers': 2, 'batch_size': 3})):
+        if np.array_equal(expected, tiled(model_key, tile_input, scale, **runner_args)):
+            print(f"  ✅ {label} output identical to serial")
+        else:
+            print(f"  ❌ {label} output differs from serial")
+    
+    threshold = 4.0
+    flat = sum(tile_complexity(tile) <= threshold for tile in crop_tiles(tile_input, boxes))
+    hybrid = tiled(model_key, tile_input, scale, flat_threshold=threshold)
+    if 0 < flat < len(boxes) and np.array_equal(hybrid, tiled_by_hand(model_key, tile_input, scale, threshold)):
+        print(f"  ✅ Hybrid ({flat} of {len(boxes)} tiles to Lanczos) matches per-tile routing")
+    else:
+        print(f"  ❌ Hybrid output differs ({flat} of {len(boxes)} tiles flat)")
+    print()
+
+print("=" * 60)
+print("IMAGE HEADER PROBE (vs cv2.imread)")
+print("=" * 60)
+
+import struct
+from upscale_script import probe_image
+
+def with_exif_orientation(jpeg, orientation, endian='>'):
+    """JPEG bytes with an APP1 EXIF block holding just the orientation tag"""
+    tiff = (b'MM' if endian == '>' else b'II') + struct.pack(endian + 'HI', 42, 8) + \
+        struct.pack(endian + 'HHHIHHI', 1, 0x0112, 3, 1, orientation, 0, 0)
+    app1 = b'Exif\x00\x00' + tiff
+    return jpeg[:2] + b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 + jpeg[2:]
+
+# Not square, so a missed EXIF rotation shows up as swapped sides
+probe_source = cv2.resize(create_test_image(), (120, 80))
+probe_gray = cv2.cvtColor(probe_source, cv2.COLOR_BGR2GRAY)
+probe_rgba = cv2.cvtColor(probe_source, cv2.COLOR_BGR2BGRA)
+probe_rgba[:, :, 3] = np.linspace(0, 255, 120, dtype=np.uint8)  # Encoders drop an all-opaque alpha
+encode = lambda ext, image, params=(): cv2.imencode(ext, image, list(params))[1].tobytes()
+jpeg = encode('.jpg', probe_source)
+probe_cases = [
+    ('PNG', encode('.png', probe_source)),
+    ('PNG grayscale', encode('.png', probe_gray)),
+    ('PNG with alpha', encode('.png', probe_rgba)),
+    ('JPEG', jpeg),
+    ('JPEG grayscale', encode('.jpg', probe_gray)),
+    ('JPEG progressive', encode('.jpg', probe_source, (cv2.IMWRITE_JPEG_PROGRESSIVE, 1))),
+    ('JPEG EXIF rotated 90 (big-endian)', with_exif_orientation(jpeg, 6)),
+    ('JPEG EXIF rotated 270 (little-endian)', with_exif_orientation(jpeg, 8, '<')),
+    ('JPEG EXIF rotated 180', with_exif_orientation(jpeg, 3)),
+    ('WebP lossy', encode('.webp', probe_source, (cv2.IMWRITE_WEBP_QUALITY, 80))),
+    ('WebP lossless', encode('.webp', probe_source, (cv2.IMWRITE_WEBP_QUALITY, 101))),
+    ('WebP lossless with alpha', encode('.webp', probe_rgba, (cv2.IMWRITE_WEBP_QUALITY, 101))),
+    ('WebP lossy with alpha', encode('.webp', probe_rgba, (cv2.IMWRITE_WEBP_QUALITY, 80))),  # VP8X header
+]
+
+with tempfile.TemporaryDirectory() as work_dir:
+    for label, data in probe_cases:
+        path = os.path.join(work_dir, 'probe')
+        with open(path, 'wb') as f:
+            f.write(data)
+        decoded = cv2.imread(path)  # Applies the EXIF orientation, as the upscaler's decode does
+        unchanged = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        expected = {"width": decoded.shape[1], "height": decoded.shape[0],
+                    "channels": 1 if unchanged.ndim == 2 else unchanged.shape[2]}
+        probed = probe_image(path)
+        from_bytes = probe_image(data)
+        if probed and all(probed[key] == value for key, value in expected.items()) and from_bytes == probed:
+            print(f"  ✅ {label}: {probed['width']}x{probed['height']}, {probed['channels']} channels ({probed['format']})")
+        else:
+            print(f"  ❌ {label}: probed {probed}, cv2.imread gives {expected}")
+print()
+
+print("=" * 60)
+print("STREAMED OUTPUT (vs in-memory tiling)")
+print("=" * 60)
+
+from upscale_script import upscale_with_tiling, upscale_with_tiling_to_file
+
+# Above MAX_DIRECT_PIXELS so the output goes through the banded path: 4 bands of 5 tiles
+stream_input = cv2.resize(create_test_image(), (600, 500), interpolation=cv2.INTER_CUBIC)
+
+for model_key, scale in (('fsrcnn_2x', 2), ('espcn_3x', 3)):
+    print(f"Testing {model_key}:")
+    if get_model_path(model_key)[0] is None:
+        print(f"  ❌ {MODELS[model_key]['file']} not found!")
+        print()
+        continue
+    expected = upscale_with_tiling(stream_input, scale, 128, 8, model_key=model_key)
+    with tempfile.TemporaryDirectory() as work_dir:
+        # PNG goes through PngRowWriter, BMP through MemmapRowWriter
+        for ext in ('.png', '.bmp'):
+            path = os.path.join(work_dir, 'streamed' + ext)
+            shape, stats = upscale_with_tiling_to_file(stream_input, path, scale, 128, 8, model_key=model_key)
+            streamed = cv2.imread(path)
+            leftovers = sorted(set(os.listdir(work_dir)) - {'streamed.png', 'streamed.bmp'})
+            if streamed is not None and np.array_equal(streamed, expected) and shape == expected.shape[:2] \
+                    and stats['bytes'] == os.path.getsize(path) and not leftovers:
+                print(f"  ✅ {ext[1:].upper()}: {shape[1]}x{shape[0]} identical to upscale_with_tiling")
+            else:
+                print(f"  ❌ {ext[1:].upper()}: streamed output differs (leftover files: {leftovers})")
+print()
+
 print("=" * 60)
 print("Test complete! Check the test_output_*.png files to compare visually.")
 print("=" * 60)
@@ -3,17 +3,26 @@ import sys
 import cv2
 from cv2 import dnn_superres
 import os
+import contextvars
+import hashlib
+import io
 import json
 import numpy as np
+import shutil
+import struct
 import subprocess
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext, ExitStack
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
-input_path = sys.argv[1]
-output_path = sys.argv[2]
-mode = sys.argv[3]  # 'upscale' or 'resize'
-options = json.loads(sys.argv[4]) if len(sys.argv) > 4 else {}
-
-# Real-ESRGAN executable path
-REALESRGAN_PATH = os.path.join(os.path.dirname(__file__), 'realesrgan', 'realesrgan-ncnn-vulkan.exe')
+# Real-ESRGAN executable path (REALESRGAN_PATH overrides the bundled binary)
+REALESRGAN_PATH = os.environ.get('REALESRGAN_PATH') or os.path.join(
+    os.path.dirname(__file__), 'realesrgan', 'realesrgan-ncnn-vulkan' + ('.exe' if os.name == 'nt' else ''))
 
 # Model configurations
 MODELS = {
@@ -28,6 +37,9 @@ MODELS = {
     'edsr_4x': {'file': 'EDSR_x4.pb', 'name': 'edsr', 'scale': 4},
 }
 
+# Where Real-ESRGAN intermediates go: tmpfs when the host has one
+SCRATCH_DIR = os.environ.get('UPSCALE_SCRATCH_DIR') or ('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+
 # Real-ESRGAN model names
 REALESRGAN_MODELS = {
     'realesrgan': 'realesrgan-x4plus',           # Best quality (32MB)
@@ -35,6 +47,9 @@ REALESRGAN_MODELS = {
     'realesrgan-anime': 'realesrgan-x4plus-anime' # Anime/art (8.5MB)
 }
 
+class ProcessingError(Exception):
+    """Raised when a job can't be completed (unreadable input, missing model, bad mode)"""
+
 def get_model_path(model_key):
     """Get model file path, checking if it exists"""
     if model_key not in MODELS:
@@ -45,6 +60,738 @@ def get_model_path(model_key):
         return None, None, None
     return model_path, config['name'], config['scale']
 
+def _read_json(path):
+    """Contents of a JSON file written by _write_json_atomic, or {} if it's missing or unreadable"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_json_atomic(path, data, indent=None):
+    """Write data as JSON to path through a temp file in the same directory, so readers never see half a file"""
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=indent)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+@contextmanager
+def _file_lock(path):
+    """Hold an exclusive lock on path + '.lock' across processes (a no-op where flock isn't available)"""
+    try:
+        import fcntl
+        f = open(path + '.lock', 'a')
+    except (ImportError, OSError):
+        yield
+        return
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+    finally:
+        f.close()  # Closing releases the lock
+
+# ============== IMAGE HEADERS ==============
+
+# Channels for each PNG colour type (palette images decode to 3)
+PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+
+def probe_image(path):
+    """Read width, height, channels and format from an image file header without decoding pixels
+    
+    Understands PNG, JPEG, GIF and WebP. Returns {"width", "height", "channels", "format"}
+    or None if the header isn't recognised. JPEG sizes follow the EXIF orientation, so they
+    match what cv2.imread returns. path may also be the encoded image bytes; anything that is
+    neither bytes nor a filesystem path gets None.
+    """
+    if not isinstance(path, (bytes, str, os.PathLike)):
+        return None
+    try:
+        with (io.BytesIO(path) if isinstance(path, bytes) else open(path, 'rb')) as f:
+            head = f.read(32)
+            if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+                width, height = struct.unpack('>II', head[16:24])
+                return {"width": width, "height": height, "channels": PNG_CHANNELS.get(head[25], 3), "format": 'png'}
+            if head[:6] in (b'GIF87a', b'GIF89a'):
+                width, height = struct.unpack('<HH', head[6:10])
+                return {"width": width, "height": height, "channels": 3, "format": 'gif'}
+            if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+                chunk = head[12:16]
+                if chunk == b'VP8 ':
+                    width, height = struct.unpack('<HH', head[26:30])
+                    width, height, alpha = width & 0x3fff, height & 0x3fff, False
+                elif chunk == b'VP8L':
+                    bits = struct.unpack('<I', head[21:25])[0]
+                    width, height = (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+                    alpha = bool(bits & (1 << 28))
+                elif chunk == b'VP8X':
+                    width = int.from_bytes(head[24:27], 'little') + 1
+                    height = int.from_bytes(head[27:30], 'little') + 1
+                    alpha = bool(head[20] & 0x10)
+                else:
+                    return None
+                return {"width": width, "height": height, "channels": 4 if alpha else 3, "format": 'webp'}
+            if head[:2] == b'\xff\xd8':
+                return _probe_jpeg(f)
+    except (OSError, struct.error):
+        pass
+    return None
+
+def _probe_jpeg(f):
+    """Walk JPEG marker segments up to the first SOF frame header, noting the EXIF orientation"""
+    f.seek(2)
+    orientation = 1
+    while True:
+        byte = f.read(1)
+        while byte and byte != b'\xff':
+            byte = f.read(1)
+        while byte == b'\xff':
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker in (0xd8, 0x01) or 0xd0 <= marker <= 0xd7:
+            continue  # Markers without a length
+        length = struct.unpack('>H', f.read(2))[0]
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            _, height, width, channels = struct.unpack('>BHHB', f.read(6))
+            if orientation in (5, 6, 7, 8):  # Rotated a quarter turn
+                width, height = height, width
+            return {"width": width, "height": height, "channels": channels, "format": 'jpeg'}
+        if marker == 0xe1:
+            data = f.read(length - 2)
+            if data.startswith(b'Exif\x00\x00'):
+                orientation = _exif_orientation(data[6:])
+            continue
+        f.seek(length - 2, os.SEEK_CUR)
+
+def _exif_orientation(tiff):
+    """Orientation tag (0x0112) from IFD0 of an EXIF TIFF block, 1 if absent"""
+    try:
+        endian = '<' if tiff[:2] == b'II' else '>'
+        offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+        count = struct.unpack(endian + 'H', tiff[offset:offset + 2])[0]
+        for i in range(count):
+            entry = offset + 2 + 12 * i
+            tag = struct.unpack(endian + 'H', tiff[entry:entry + 2])[0]
+            if tag == 0x0112:
+                return struct.unpack(endian + 'H', tiff[entry + 8:entry + 10])[0]
+    except struct.error:
+        pass
+    return 1
+
+def probe_images(paths):
+    """Probe each path, one entry per path in order
+    
+    Formats the header parser doesn't know (BMP, TIFF, ...) are decoded with OpenCV instead;
+    unreadable paths get an "error" entry.
+    """
+    entries = []
+    for path in paths:
+        info = probe_image(path)
+        if info is None:
+            image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+            if image is None:
+                entries.append({"path": path, "error": "Could not read image"})
+                continue
+            info = {"width": image.shape[1], "height": image.shape[0],
+                    "channels": 1 if image.ndim == 2 else image.shape[2],
+                    "format": os.path.splitext(path)[1].lower().lstrip('.') or 'unknown'}
+        entries.append({"path": path, **info})
+    return entries
+
+# ============== INSTRUMENTATION ==============
+
+class JobMetrics:
+    """Per-stage timings and tiling details for one job, reported in its result JSON
+    
+    Stages can be timed from any thread working on the job, so with parallel tiles the
+    stage totals add up thread time and can exceed the job's wall-clock time.
+    """
+    
+    STAGES = ('decode', 'modelLoad', 'inference', 'blend', 'resize', 'encode')
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self.stages = dict.fromkeys(self.STAGES, 0.0)
+        self.timed_stages = set()
+        self.tile_ms = []
+        self.tiling = None
+        self.tile_paths = None
+        self.tile_dedup = None
+        self.inference = {}
+    
+    @property
+    def elapsed_ms(self):
+        """Wall-clock time since the job started"""
+        return (time.perf_counter() - self._start) * 1000
+    
+    def add(self, stage, elapsed_ms):
+        with self._lock:
+            self.stages[stage] += elapsed_ms
+            self.timed_stages.add(stage)
+    
+    def add_tiles(self, elapsed_ms, count):
+        """Inference time for a batch of `count` tiles (split evenly between them)"""
+        with self._lock:
+            self.stages['inference'] += elapsed_ms
+            self.timed_stages.add('inference')
+            self.tile_ms.extend([elapsed_ms / count] * count)
+    
+    def add_tile_paths(self, model, lanczos):
+        """Count tiles sent to the network and to Lanczos by hybrid tiling"""
+        with self._lock:
+            counts = self.tile_paths or {"model": 0, "lanczos": 0}
+            self.tile_paths = {"model": counts['model'] + model, "lanczos": counts['lanczos'] + lanczos}
+    
+    def add_tile_dedup(self, inferred, job_hits, shared_hits):
+        """Count tiles run through the network and tiles reused from the job's or TILE_CACHE's results"""
+        with self._lock:
+            counts = self.tile_dedup or {"inferred": 0, "jobHits": 0, "sharedHits": 0}
+            self.tile_dedup = {"inferred": counts['inferred'] + inferred, "jobHits": counts['jobHits'] + job_hits,
+                               "sharedHits": counts['sharedHits'] + shared_hits}
+    
+    def add_model(self, model_key, profile):
+        """Note the inference profile (precision, threads, PSNR delta) a MODELS network ran with"""
+        with self._lock:
+            self.inference[model_key] = profile
+    
+    def set_tiling(self, boxes, tile_size, overlap):
+        self.tiling = {
+            "grid": [len({box[0] for box in boxes}), len({box[2] for box in boxes})],
+            "tiles": len(boxes),
+            "tileSize": tile_size,
+            "overlap": overlap
+        }
+    
+    def report(self):
+        with self._lock:
+            report = {"timings": {"totalMs": round(self.elapsed_ms, 1),
+                                  **{f"{stage}Ms": round(ms, 1) for stage, ms in self.stages.items()}}}
+            if self.inference:
+                report['inference'] = {model_key: dict(profile) for model_key, profile in self.inference.items()}
+            if self.tiling is not None:
+                tile_ms = sorted(self.tile_ms)
+                report['tiling'] = dict(self.tiling)
+                if tile_ms:
+                    report['tiling']['tileInferenceMs'] = {
+                        "mean": round(sum(tile_ms) / len(tile_ms), 1),
+                        "p50": round(tile_ms[len(tile_ms) // 2], 1),
+                        "p95": round(tile_ms[min(len(tile_ms) - 1, int(len(tile_ms) * 0.95))], 1),
+                        "max": round(tile_ms[-1], 1)
+                    }
+                if self.tile_dedup is not None:
+                    report['tiling']['dedup'] = dict(self.tile_dedup)
+                if self.tile_paths is not None:
+                    total = self.tile_paths['model'] + self.tile_paths['lanczos']
+                    report['tiling']['paths'] = {
+                        **self.tile_paths,
+                        "modelFraction": round(self.tile_paths['model'] / total, 4) if total else 0.0,
+                        "lanczosFraction": round(self.tile_paths['lanczos'] / total, 4) if total else 0.0
+                    }
+            return report
+
+# Metrics of the job running in the current context (None outside run_job)
+_job_metrics = contextvars.ContextVar('job_metrics', default=None)
+
+def current_metrics():
+    return _job_metrics.get()
+
+@contextmanager
+def timed(stage):
+    """Add the time spent in the block to `stage` of the current job, if there is one"""
+    metrics = _job_metrics.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add(stage, (time.perf_counter() - start) * 1000)
+
+# Listener for the current job's interim replies (None outside run_job or when nobody listens)
+_job_events = contextvars.ContextVar('job_events', default=None)
+
+def emit_event(status, payload):
+    """Hand an interim reply for the current job (a preview, progress) to whoever is running it"""
+    listener = _job_events.get()
+    if listener is not None:
+        listener(status, payload)
+
+def peak_rss_mb(include_children=False):
+    """Peak resident memory of this process so far (None where the OS doesn't report it)
+    
+    include_children also counts the largest child process waited for (Real-ESRGAN, ffmpeg).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if include_children:
+        peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is KB on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def with_peak_rss(result):
+    """result plus peakRssMb, for a process that ran nothing but this one job
+    
+    The process's peak memory (and that of the tools it ran) is then the job's.
+    """
+    return {**result, "peakRssMb": peak_rss_mb(include_children=True)}
+
+class BatchedSuperRes:
+    """Runs a MODELS network through cv2.dnn directly so equal-sized images share a forward pass
+    
+    Pre- and post-processing mirror dnn_superres: FSRCNN/ESPCN see only the Y channel of
+    YCrCb (Cr/Cb are resized bilinearly), EDSR sees mean-subtracted BGR. upsample() is a
+    drop-in for DnnSuperResImpl.upsample.
+    
+    The DepthToSpace layer dnn_superres registers only handles one image per blob, so a
+    batch is run up to that layer and the pixel shuffle (plus the elementwise layers
+    after it) is done here. Graphs that don't end that way run one image per pass.
+    
+    precision='fp16' runs the network on OpenCV's FP16 CPU target and precision='int8' on
+    weights quantized against a calibration image (see INFERENCE PROFILES). Quantized
+    layers hand out int8 blobs, so an int8 network always runs one image per pass.
+    """
+    
+    # BGR mean of the DIV2K dataset, as used by dnn_superres for EDSR
+    EDSR_MEAN = (103.1545782, 111.561547, 114.35629928)
+    
+    def __init__(self, model_key, precision='fp32'):
+        model_path, self.name, self.scale = get_model_path(model_key)
+        if model_path is None:
+            raise ProcessingError(f"Error: Model file for {model_key} not found")
+        self.precision = precision
+        # Creating a DnnSuperResImpl registers the DepthToSpace layer these graphs need
+        dnn_superres.DnnSuperResImpl_create()
+        self.net = cv2.dnn.readNetFromTensorflow(model_path)
+        if precision == 'int8':
+            # quantize() leaves the float network unusable, which is fine as it's replaced
+            self.net = self.net.quantize([self._calibration_blob()], cv2.CV_32F, cv2.CV_32F)
+            self.body_output, self.tail = None, None
+        else:
+            if precision == 'fp16':
+                self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU_FP16)
+            # Probe on a separate copy: asking for intermediate outputs stops layer fusion for good
+            self.body_output, self.tail = self._split_graph(cv2.dnn.readNetFromTensorflow(model_path))
+    
+    def _calibration_blob(self):
+        """Input blob for int8 calibration: smooth texture over the whole 0-255 range"""
+        coarse = np.random.RandomState(0).randint(0, 256, (16, 16, 3)).astype(np.uint8)
+        image = cv2.resize(coarse, (128, 128), interpolation=cv2.INTER_CUBIC)
+        if self.name == 'edsr':
+            return cv2.dnn.blobFromImage(image, 1.0, mean=self.EDSR_MEAN)
+        y = cv2.cvtColor(image, cv2.COLOR_BGR2YCrCb)[:, :, 0].astype(np.float32) / 255.0
+        return cv2.dnn.blobFromImage(y, 1.0)
+    
+    def _split_graph(self, net):
+        """Find the layer feeding the final DepthToSpace and a numpy version of what follows it
+        
+        Returns (None, None) if the graph can't be batched.
+        """
+        names = list(net.getLayerNames())
+        shuffles = [i for i, name in enumerate(names) if net.getLayer(name).type == 'DepthToSpace']
+        if len(shuffles) != 1 or shuffles[0] == 0:
+            return None, None
+        after = names[shuffles[0] + 1:]
+        if any(net.getLayer(name).type not in ('Power', 'TanH', 'Identity') for name in after):
+            return None, None
+        
+        # Fit the elementwise tail on a probe image (one image per pass is always correct)
+        channels = 3 if self.name == 'edsr' else 1
+        probe = np.random.RandomState(0).rand(channels, 8, 8).astype(np.float32)
+        net.setInput(probe[None])
+        shuffled, out = net.forward([names[shuffles[0]], names[-1]])
+        candidates = [lambda x: x, np.tanh]
+        if after and net.getLayer(after[0]).type == 'Power':
+            slope, intercept = np.polyfit(shuffled.ravel(), out.ravel(), 1)
+            candidates.append(lambda x: x * np.float32(slope) + np.float32(intercept))
+        for tail in candidates:
+            if np.abs(tail(shuffled) - out).max() < 1e-5:
+                return names[shuffles[0] - 1], tail
+        return None, None
+    
+    def _forward(self, blob):
+        if self.body_output is None:
+            outputs = []
+            for item in blob:
+                self.net.setInput(item[None])
+                outputs.append(self.net.forward()[0])
+            return np.stack(outputs)
+        
+        self.net.setInput(blob)
+        body = self.net.forward(self.body_output)
+        n, c, h, w = body.shape
+        s = self.scale
+        # TF DepthToSpace: channel (i * s + j) * C + k goes to pixel (y * s + i, x * s + j), channel k
+        out_c = c // (s * s)
+        shuffled = body.reshape(n, s, s, out_c, h, w).transpose(0, 3, 4, 1, 5, 2).reshape(n, out_c, h * s, w * s)
+        return self.tail(shuffled)
+    
+    def upsample(self, image):
+        return self.upsample_batch([image])[0]
+    
+    def upsample_batch(self, images):
+        """Upscale a list of same-sized BGR uint8 images in one forward pass"""
+        if self.name == 'edsr':
+            out = self._forward(cv2.dnn.blobFromImages(images, 1.0, mean=self.EDSR_MEAN))
+            mean = np.array(self.EDSR_MEAN, dtype=np.float32)
+            return [np.clip(np.rint(plane.transpose(1, 2, 0) + mean), 0, 255).astype(np.uint8)
+                    for plane in out]
+        
+        ycrcb = [cv2.cvtColor(image, cv2.COLOR_BGR2YCrCb).astype(np.float32) / 255.0 for image in images]
+        out = self._forward(cv2.dnn.blobFromImages([np.ascontiguousarray(img[:, :, 0]) for img in ycrcb], 1.0))
+        results = []
+        for y, img in zip(out, ycrcb):
+            cr = cv2.resize(np.ascontiguousarray(img[:, :, 1]), None, fx=self.scale, fy=self.scale)
+            cb = cv2.resize(np.ascontiguousarray(img[:, :, 2]), None, fx=self.scale, fy=self.scale)
+            merged = cv2.merge([y[0], cr, cb])
+            merged = np.clip(np.rint(merged * 255.0), 0, 255).astype(np.uint8)
+            results.append(cv2.cvtColor(merged, cv2.COLOR_YCrCb2BGR))
+        return results
+
+def upsample_tiles(sr, tiles):
+    """Upscale a list of same-sized tiles, in one pass if the engine supports batching"""
+    if hasattr(sr, 'upsample_batch'):
+        return sr.upsample_batch(tiles)
+    return [sr.upsample(tile) for tile in tiles]
+
+class ModelRegistry:
+    """Hands out loaded super-resolution engines by MODELS key
+    
+    engine='superres' gives a DnnSuperResImpl, engine='batched' a BatchedSuperRes. Any
+    precision other than 'fp32' needs the network itself, so it always gets a BatchedSuperRes.
+    An instance is only ever used by one thread at a time, so concurrent jobs on the
+    same model get separate instances. Idle instances are kept warm and evicted least
+    recently used first once the estimated memory of everything loaded exceeds the budget.
+    """
+    
+    def __init__(self, memory_budget_mb=1024):
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        self._idle = OrderedDict()  # (model_key, engine, precision) -> [instances], least recently used first
+        self._loaded_bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "loads": 0, "loadTimeMs": 0.0}
+    
+    @staticmethod
+    def model_size(model_key):
+        """Estimated memory for one loaded instance (the weights dominate, so use the file size)"""
+        return os.path.getsize(MODELS[model_key]['file'])
+    
+    @staticmethod
+    def _key(model_key, engine, precision):
+        return model_key, 'batched' if precision != 'fp32' else engine, precision
+    
+    def _load(self, model_key, engine, precision):
+        model_path, model_name, scale = get_model_path(model_key)
+        if model_path is None:
+            return None
+        start = time.perf_counter()
+        with timed('modelLoad'):
+            if engine == 'batched':
+                sr = BatchedSuperRes(model_key, precision)
+            else:
+                sr = dnn_superres.DnnSuperResImpl_create()
+                sr.readModel(model_path)
+                sr.setModel(model_name, scale)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self._stats['loads'] += 1
+            self._stats['loadTimeMs'] += elapsed_ms
+        print(f"Loaded model {model_key} ({engine}, {precision}) in {elapsed_ms:.0f}ms", file=sys.stderr)
+        return sr
+    
+    def _evict(self):
+        """Drop idle instances, oldest first, until we're back under budget (caller holds the lock)"""
+        while self._loaded_bytes > self.memory_budget and self._idle:
+            key, instances = next(iter(self._idle.items()))
+            instances.pop(0)
+            if not instances:
+                del self._idle[key]
+            self._loaded_bytes -= self.model_size(key[0])
+            self._stats['evictions'] += 1
+    
+    def checkout(self, model_key, engine='superres', precision='fp32'):
+        """Take exclusive use of an instance for model_key, or None if the model file is missing
+        
+        Pair every successful checkout with checkin(); prefer the acquire() context manager.
+        """
+        key = self._key(model_key, engine, precision)
+        with self._lock:
+            instances = self._idle.get(key)
+            if instances:
+                self._stats['hits'] += 1
+                sr = instances.pop()
+                if not instances:
+                    del self._idle[key]
+                return sr
+        
+        sr = self._load(*key)
+        if sr is None:
+            return None
+        with self._lock:
+            self._stats['misses'] += 1
+            self._loaded_bytes += self.model_size(model_key)
+            self._evict()
+        return sr
+    
+    def checkin(self, model_key, sr, engine='superres', precision='fp32'):
+        """Return an instance to the idle pool as the most recently used"""
+        key = self._key(model_key, engine, precision)
+        with self._lock:
+            self._idle.setdefault(key, []).append(sr)
+            self._idle.move_to_end(key)
+            self._evict()
+    
+    @contextmanager
+    def acquire(self, model_key, engine='superres', precision='fp32'):
+        """Context manager yielding a loaded instance (or None if the model isn't available)"""
+        sr = self.checkout(model_key, engine, precision)
+        try:
+            yield sr
+        finally:
+            if sr is not None:
+                self.checkin(model_key, sr, engine, precision)
+    
+    def preload(self, model_keys, engine='superres'):
+        """Load the given models up front so the first jobs don't pay for it"""
+        for model_key in model_keys:
+            if model_key not in MODELS:
+                print(f"Warning: Unknown model {model_key}, not preloading", file=sys.stderr)
+                continue
+            sr = self.checkout(model_key, engine)
+            if sr is None:
+                print(f"Warning: Model file for {model_key} not found, not preloading", file=sys.stderr)
+                continue
+            self.checkin(model_key, sr, engine)
+    
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                "loadTimeMs": round(self._stats['loadTimeMs'], 1),
+                "hitRatio": round(self._stats['hits'] / lookups, 4) if lookups else 0.0,
+                "loadedBytes": self._loaded_bytes,
+                "memoryBudgetBytes": self.memory_budget,
+                "idle": {f"{model_key}:{engine}" + (f":{precision}" if precision != 'fp32' else ''): len(instances)
+                         for (model_key, engine, precision), instances in self._idle.items()}
+            }
+
+MODEL_REGISTRY = ModelRegistry(int(os.environ.get('UPSCALE_MODEL_MEMORY_MB', 1024)))
+
+class CallCoalescer:
+    """Gathers concurrent calls with the same key into groups that are handled together
+    
+    The first caller for a key waits up to window_ms for others to join, then calls
+    run_group(key, group) for the whole group; a group that reaches max_batch runs straight
+    away. group is a list of (item, Future) and run_group must resolve every future.
+    Each caller gets its own future's result back from submit().
+    """
+    
+    def __init__(self, run_group, window_ms, max_batch=8):
+        self.run_group = run_group
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pending = {}  # key -> [(item, future)]
+    
+    def submit(self, key, item):
+        entry = (item, Future())
+        with self._lock:
+            group = self._pending.setdefault(key, [])
+            group.append(entry)
+            leader = len(group) == 1
+            full = len(group) >= self.max_batch
+            if full:
+                del self._pending[key]
+        
+        if full:
+            self.run_group(key, group)
+        elif leader:
+            time.sleep(self.window)
+            with self._lock:
+                # A later caller may already have run the group because it filled up
+                flush = self._pending.get(key) is group
+                if flush:
+                    del self._pending[key]
+            if flush:
+                self.run_group(key, group)
+        return entry[1].result()
+
+class InferenceBatcher:
+    """Coalesces single-image inference from concurrent jobs into batched forward passes
+    
+    Calls for the same (model, precision, image size) are grouped by a CallCoalescer
+    and each group goes through one BatchedSuperRes pass.
+    """
+    
+    def __init__(self, window_ms=10, max_batch=8):
+        self._coalescer = CallCoalescer(self._run, window_ms, max_batch)
+        self._lock = threading.Lock()
+        self._stats = {"batches": 0, "images": 0}
+    
+    def upsample(self, model_key, image, precision='fp32'):
+        return self._coalescer.submit((model_key, precision, image.shape), image)
+    
+    def _run(self, key, group):
+        model_key, precision, _ = key
+        try:
+            with MODEL_REGISTRY.acquire(model_key, 'batched', precision) as sr:
+                if sr is None:
+                    raise ProcessingError(f"Error: Model file for {model_key} not found")
+                results = sr.upsample_batch([image for image, _ in group])
+        except Exception as e:
+            for _, future in group:
+                future.set_exception(e)
+            return
+        with self._lock:
+            self._stats['batches'] += 1
+            self._stats['images'] += len(group)
+        for (_, future), result in zip(group, results):
+            future.set_result(result)
+    
+    def stats(self):
+        with self._lock:
+            batches = self._stats['batches']
+            return {**self._stats, "meanBatchSize": round(self._stats['images'] / batches, 2) if batches else 0.0}
+
+# Set by the worker (--batch-window-ms) to batch untiled MODELS inference across jobs
+INFERENCE_BATCHER = None
+
+def upsample_with_model(model_key, image):
+    """Upscale image with a MODELS network, or return None if its model file is missing"""
+    if get_model_path(model_key)[0] is None:
+        return None
+    precision = inference_precision(model_key)
+    if INFERENCE_BATCHER is not None:
+        with timed('inference'):
+            return INFERENCE_BATCHER.upsample(model_key, image, precision)
+    with MODEL_REGISTRY.acquire(model_key, 'superres', precision) as sr:
+        if sr is None:
+            return None
+        with timed('inference'):
+            return sr.upsample(image)
+
+class RealEsrganBackend:
+    """Runs the realesrgan-ncnn-vulkan executable, optionally batching concurrent jobs
+    
+    With window_ms > 0, jobs for the same (model, scale, output format) are grouped by a
+    CallCoalescer and each group goes through one directory-mode invocation so model load
+    and device init are paid once. Any executable that takes the same -i/-o/-n/-s/-f arguments works,
+    which is how the backend is exercised on hosts without a GPU.
+    """
+    
+    def __init__(self, executable=None, timeout=120, window_ms=0, max_batch=8):
+        self.executable = executable
+        self.timeout = timeout
+        self._coalescer = CallCoalescer(self._run_group, window_ms, max_batch) if window_ms > 0 else None
+        self._lock = threading.Lock()
+        self._stats = {"invocations": 0, "images": 0, "failures": 0}
+    
+    @property
+    def path(self):
+        # Read REALESRGAN_PATH late so callers (and tests) can repoint the module default
+        return self.executable or REALESRGAN_PATH
+    
+    def run(self, input_path, output_path, scale, model_name):
+        """Upscale one file into output_path; returns True on success"""
+        if not os.path.exists(self.path):
+            print(f"Error: Real-ESRGAN not found at {self.path}", file=sys.stderr)
+            return False
+        if self._coalescer is None:
+            return self._invoke(input_path, output_path, model_name, scale, 1)
+        
+        fmt = os.path.splitext(output_path)[1].lower().lstrip('.').replace('jpeg', 'jpg') or 'png'
+        return self._coalescer.submit((model_name, scale, fmt), (input_path, output_path))
+    
+    def run_directory(self, input_dir, output_dir, scale, model_name, count, fmt='png'):
+        """Upscale the `count` images in input_dir into output_dir with one invocation; returns True on success"""
+        if not os.path.exists(self.path):
+            print(f"Error: Real-ESRGAN not found at {self.path}", file=sys.stderr)
+            return False
+        return self._invoke(input_dir, output_dir, model_name, scale, count, fmt)
+    
+    def _invoke(self, input_path, output_path, model_name, scale, count, fmt=None):
+        """Run the executable once over a file or directory; returns True on a clean exit"""
+        cmd = [self.path, '-i', input_path, '-o', output_path, '-n', model_name, '-s', str(scale)]
+        if fmt:
+            cmd += ['-f', fmt]
+        timeout = self.timeout * count
+        print(f"Running Real-ESRGAN with model: {model_name}, scale: {scale}x"
+              + (f", batch: {count}" if count > 1 else ""), file=sys.stderr)
+        with self._lock:
+            self._stats['invocations'] += 1
+            self._stats['images'] += count
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+            if result.returncode != 0:
+                print(f"Real-ESRGAN error: {result.stderr}", file=sys.stderr)
+                ok = False
+            else:
+                ok = True
+        except subprocess.TimeoutExpired:
+            print(f"Real-ESRGAN timed out after {timeout} seconds", file=sys.stderr)
+            ok = False
+        except Exception as e:
+            print(f"Real-ESRGAN exception: {str(e)}", file=sys.stderr)
+            ok = False
+        if not ok:
+            with self._lock:
+                self._stats['failures'] += 1
+        return ok
+    
+    def _run_group(self, key, group):
+        """Stage the group's inputs in one directory, run once, and hand each output back"""
+        model_name, scale, fmt = key
+        if len(group) == 1:
+            (input_path, output_path), future = group[0]
+            future.set_result(self._invoke(input_path, output_path, model_name, scale, 1))
+            return
+        
+        try:
+            with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as work_dir:
+                in_dir = os.path.join(work_dir, 'in')
+                out_dir = os.path.join(work_dir, 'out')
+                os.mkdir(in_dir)
+                os.mkdir(out_dir)
+                for index, ((input_path, _), _) in enumerate(group):
+                    staged = os.path.join(in_dir, f"{index}{os.path.splitext(input_path)[1]}")
+                    try:
+                        os.link(input_path, staged)
+                    except OSError:
+                        shutil.copyfile(input_path, staged)
+                
+                ok = self._invoke(in_dir, out_dir, model_name, scale, len(group), fmt)
+                for index, ((_, output_path), future) in enumerate(group):
+                    produced = os.path.join(out_dir, f"{index}.{fmt}")
+                    if ok and os.path.exists(produced):
+                        shutil.move(produced, output_path)
+                        future.set_result(True)
+                    else:
+                        future.set_result(False)
+        except Exception as e:
+            print(f"Real-ESRGAN batch failed: {str(e)}", file=sys.stderr)
+            for _, future in group:
+                if not future.done():
+                    future.set_result(False)
+    
+    def stats(self):
+        with self._lock:
+            invocations = self._stats['invocations']
+            return {**self._stats, "meanBatchSize": round(self._stats['images'] / invocations, 2) if invocations else 0.0}
+
+# Replaced by the worker (--realesrgan-window-ms) to batch Real-ESRGAN runs across jobs
+REALESRGAN_BACKEND = RealEsrganBackend(timeout=int(os.environ.get('REALESRGAN_TIMEOUT', 120)))
+
 def upscale_with_realesrgan(input_path, output_path, scale=4, model_name='realesrgan-x4plus'):
     """High-quality upscaling using Real-ESRGAN (GPU accelerated)
     
@@ -53,327 +800,2815 @@ def upscale_with_realesrgan(input_path, output_path, scale=4, model_name='reales
     - realesr-animevideov3: Fast, good for video/general (1.2MB)
     - realesrgan-x4plus-anime: Best for anime/artwork (8.5MB)
     """
-    if not os.path.exists(REALESRGAN_PATH):
-        print(f"Error: Real-ESRGAN not found at {REALESRGAN_PATH}", file=sys.stderr)
-        return False
-    
-    # Build command
-    cmd = [
-        REALESRGAN_PATH,
-        '-i', input_path,
-        '-o', output_path,
-        '-n', model_name,
-        '-s', str(scale)
-    ]
-    
-    print(f"Running Real-ESRGAN with model: {model_name}, scale: {scale}x", file=sys.stderr)
+    return REALESRGAN_BACKEND.run(input_path, output_path, scale, model_name)
+
+def realesrgan_to_file(input_path, output_path, scale, model_name, native_scale, size,
+                       quality=None, preset='balanced'):
+    """Run Real-ESRGAN and leave a `scale`x result at output_path
     
+    Returns (shape, encode stats), or None on failure. The binary writes into SCRATCH_DIR and
+    the result goes to output_path through write_image, so quality and preset apply as they
+    do for every other engine. When the model only runs at a larger native scale the result
+    is reduced once on the way. Lossy outputs then go through a q100 JPEG intermediate so the
+    reduction can happen during decode (IMREAD_REDUCED_*) instead of after a full-size decode;
+    otherwise the intermediate is a lossless PNG. The reduced size comes from the intermediate
+    itself, since the binary doesn't apply EXIF orientation the way `size` (from probe_image) does.
+    """
+    w, h = size
+    lossy = native_scale != scale and os.path.splitext(output_path)[1].lower() in ('.jpg', '.jpeg', '.webp')
+    factor = native_scale / scale
+    reduced_flag = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}.get(factor) if lossy else None
+    fd, scratch_path = tempfile.mkstemp(suffix='.jpg' if lossy else '.png', dir=SCRATCH_DIR)
+    os.close(fd)
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
-        if result.returncode != 0:
-            print(f"Real-ESRGAN error: {result.stderr}", file=sys.stderr)
-            return False
-        return True
-    except subprocess.TimeoutExpired:
-        print("Real-ESRGAN timed out after 120 seconds", file=sys.stderr)
-        return False
-    except Exception as e:
-        print(f"Real-ESRGAN exception: {str(e)}", file=sys.stderr)
-        return False
+        with timed('inference'):
+            ok = upscale_with_realesrgan(input_path, scratch_path, native_scale, model_name)
+        if not ok:
+            return None
+        with timed('decode'):
+            if reduced_flag is not None:
+                result = cv2.imread(scratch_path, reduced_flag)
+            else:
+                result = cv2.imread(scratch_path)
+        if result is None:
+            print("Real-ESRGAN output could not be read", file=sys.stderr)
+            return None
+        info = probe_image(scratch_path)
+        if info:
+            target_w, target_h = info['width'] * scale // native_scale, info['height'] * scale // native_scale
+        else:
+            target_w, target_h = w * scale, h * scale
+        if result.shape[:2] != (target_h, target_w):
+            with timed('resize'):
+                result = cv2.resize(result, (target_w, target_h), interpolation=cv2.INTER_AREA)
+        return result.shape, write_image(output_path, result, quality, preset)
+    finally:
+        os.unlink(scratch_path)
 
 def upscale_lite(image, scale=2):
     """Fast upscaling using FSRCNN (Lite mode - legacy)
     Falls back to ESPCN if FSRCNN not available, then to bicubic interpolation
     """
-    sr = dnn_superres.DnnSuperResImpl_create()
+    # Try FSRCNN first (fastest), then ESPCN
+    for model_key in (f'fsrcnn_{scale}x', f'espcn_{scale}x'):
+        result = upsample_with_model(model_key, image)
+        if result is not None:
+            return result
+    
+    # Ultimate fallback: bicubic interpolation
+    print(f"Warning: No lite model found for {scale}x, using bicubic interpolation", file=sys.stderr)
+    h, w = image.shape[:2]
+    with timed('resize'):
+        return cv2.resize(image, (w * scale, h * scale), interpolation=cv2.INTER_CUBIC)
+
+# If image is small enough, process directly without tiling
+MAX_DIRECT_PIXELS = 512 * 512  # ~262k pixels
+
+# Outputs at least this large are streamed to disk band by band (upscale_with_tiling_to_file)
+STREAMING_MIN_OUTPUT_PIXELS = int(os.environ.get('UPSCALE_STREAMING_MIN_PIXELS', 4096 * 4096))
+
+# ============== INFERENCE PROFILES ==============
+# Precision and OpenCV thread count the MODELS networks run at. 'fp32' is the reference;
+# 'fp16' and 'int8' trade fidelity for speed where cv2.dnn supports them on this CPU.
+# `upscale_script.py --profile-inference` measures each precision's time per thread count
+# and PSNR delta against fp32 on this host. Jobs pick a profile with the options
+# inferencePrecision/inferenceThreads, or get their tier's TIER_PRECISION.
+
+INFERENCE_PRECISIONS = ('fp32', 'fp16', 'int8')
+
+# Thread counts profile_inference times each precision at
+INFERENCE_THREAD_COUNTS = tuple(n for n in (1, 2, 4, 8, 16) if n < (os.cpu_count() or 1)) + (os.cpu_count() or 1,)
+
+# Side of the high-res reference profile_inference downscales its test input from
+INFERENCE_PROFILE_SIDE = 384
+
+# fp16/int8 only run on a model profile_inference measured losing at most this much PSNR
+# (dB against fp32) and running faster than fp32; anything else runs at fp32
+INFERENCE_MAX_PSNR_LOSS_DB = float(os.environ.get('UPSCALE_INFERENCE_MAX_PSNR_LOSS', 1.0))
+
+# Set by the worker (--tier-precision) to run a tier's jobs at a cheaper precision by default
+TIER_PRECISION = {}
+
+@lru_cache(maxsize=None)
+def precision_available(precision):
+    """Whether cv2.dnn can run the MODELS networks at precision on this CPU"""
+    if precision == 'fp16':
+        return hasattr(cv2.dnn, 'DNN_TARGET_CPU_FP16') and \
+            cv2.dnn.DNN_TARGET_CPU_FP16 in cv2.dnn.getAvailableTargets(cv2.dnn.DNN_BACKEND_OPENCV)
+    if precision == 'int8':
+        return hasattr(cv2.dnn.Net, 'quantize')
+    return precision == 'fp32'
+
+class InferenceProfiles:
+    """Measured time and PSNR delta of each precision per MODELS key, from a JSON file written by profile_inference"""
     
-    # Try FSRCNN first (fastest)
-    model_key = f'fsrcnn_{scale}x'
-    model_path, model_name, _ = get_model_path(model_key)
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._profiles = _read_json(path)
     
-    if model_path is None:
-        # Fallback to ESPCN
-        model_key = f'espcn_{scale}x'
-        model_path, model_name, _ = get_model_path(model_key)
+    def measurement(self, model_key, precision):
+        """profile_inference's results for model_key at precision, or None if it wasn't measured here"""
+        with self._lock:
+            measured = self._profiles.get(model_key, {}).get(precision)
+        return measured if measured and measured.get('available') else None
     
-    if model_path is None:
-        # Ultimate fallback: bicubic interpolation
-        print(f"Warning: No lite model found for {scale}x, using bicubic interpolation", file=sys.stderr)
-        h, w = image.shape[:2]
-        return cv2.resize(image, (w * scale, h * scale), interpolation=cv2.INTER_CUBIC)
+    def psnr_delta(self, model_key, precision):
+        """PSNR change (dB) against fp32 measured for model_key at precision, or None if it wasn't measured"""
+        if precision == 'fp32':
+            return 0.0
+        measured = self.measurement(model_key, precision)
+        return measured['psnrDeltaDb'] if measured else None
     
-    sr.readModel(model_path)
-    sr.setModel(model_name, scale)
-    return sr.upsample(image)
+    def update(self, model_key, profile):
+        """Store a measured profile for model_key and persist the file"""
+        with self._lock:
+            self._profiles[model_key] = profile
+            snapshot = dict(self._profiles)
+        try:
+            _write_json_atomic(self.path, snapshot, indent=2)
+        except OSError as e:
+            print(f"Warning: Could not save inference profile: {str(e)}", file=sys.stderr)
+    
+    def stats(self):
+        with self._lock:
+            return {key: {precision: {name: profile[precision].get(name) for name in ('psnrDeltaDb', 'bestThreads', 'speedup')}
+                          for precision in INFERENCE_PRECISIONS if profile.get(precision, {}).get('available')}
+                    for key, profile in self._profiles.items()}
 
-def upscale_with_tiling(image, scale=2, tile_size=256, overlap=16):
-    """High-quality upscaling using EDSR with tiling (Pro mode)
-    Processes image in tiles to prevent RAM overflow on weak servers
+INFERENCE_PROFILES = InferenceProfiles(os.environ.get('UPSCALE_INFERENCE_PROFILE') or
+                                       os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inference_profile.json'))
+
+# Precision the current job asked for ('fp32' outside run_job)
+_inference_precision = contextvars.ContextVar('inference_precision', default='fp32')
+
+def inference_settings(options):
+    """(precision, threads) for a job: options inferencePrecision (else its tier's TIER_PRECISION) and inferenceThreads"""
+    precision = options.get('inferencePrecision') or TIER_PRECISION.get(options.get('tier', 'free'), 'fp32')
+    if precision not in INFERENCE_PRECISIONS:
+        raise ProcessingError(f"Error: Unknown inference precision: {precision}")
+    threads = options.get('inferenceThreads')
+    return precision, max(1, int(threads)) if threads else None
+
+def inference_precision(model_key):
+    """Precision the current job runs model_key at, noted in the job's metrics
+    
+    A reduced precision only runs where profile_inference has measured it on this model and
+    host, within INFERENCE_MAX_PSNR_LOSS_DB of fp32 and faster than it. Otherwise (including
+    when cv2.dnn can't run it on this CPU, or it was never measured) the model runs at fp32.
     """
-    sr = dnn_superres.DnnSuperResImpl_create()
+    requested = precision = _inference_precision.get()
+    if precision != 'fp32':
+        measured = INFERENCE_PROFILES.measurement(model_key, precision)
+        if not precision_available(precision):
+            print(f"Warning: {precision} inference isn't available on this CPU, using fp32", file=sys.stderr)
+            precision = 'fp32'
+        elif measured is None:
+            print(f"Warning: {precision} {model_key} hasn't been measured with --profile-inference, using fp32",
+                  file=sys.stderr)
+            precision = 'fp32'
+        elif measured['psnrDeltaDb'] < -INFERENCE_MAX_PSNR_LOSS_DB or measured['speedup'] <= 1.0:
+            print(f"Warning: {precision} {model_key} measured {measured['psnrDeltaDb']:+g}dB PSNR at "
+                  f"{measured['speedup']:g}x fp32's speed, using fp32", file=sys.stderr)
+            precision = 'fp32'
+    if current_metrics() is not None:
+        current_metrics().add_model(model_key, {"precision": precision, "requestedPrecision": requested,
+                                                "threads": cv2.getNumThreads(),
+                                                "psnrDeltaDb": INFERENCE_PROFILES.psnr_delta(model_key, precision)})
+    return precision
+
+def _profile_reference(side):
+    """Deterministic high-res test content: gradients, smooth texture, text and fine lines"""
+    y, x = np.mgrid[0:side, 0:side]
+    gradient = np.dstack([40 + 160 * y / side, 30 + 160 * x / side, 60 + 80 * (x + y) / side]).astype(np.uint8)
+    coarse = np.random.RandomState(0).randint(0, 256, (side // 24, side // 24, 3)).astype(np.uint8)
+    image = cv2.addWeighted(gradient, 0.6, cv2.resize(coarse, (side, side), interpolation=cv2.INTER_CUBIC), 0.4, 0)
+    cv2.putText(image, "Profile 0123", (side // 16, side // 2), cv2.FONT_HERSHEY_SIMPLEX, side / 320,
+                (255, 255, 255), max(1, side // 128))
+    for i in range(side // 16, side // 4, 4):
+        cv2.line(image, (side // 2, i), (side - side // 16, i), (20, 20, 20), 1)
+    return image
+
+def profile_inference(model_key, repeats=3):
+    """Measure every precision of model_key on this host, save the results and return them
     
-    model_key = f'edsr_{scale}x'
-    model_path, model_name, _ = get_model_path(model_key)
+    A high-res reference is downscaled, upscaled back at each precision cv2.dnn can run here
+    and compared with the original: psnrDeltaDb is that precision's PSNR minus fp32's. Each
+    precision is timed at every INFERENCE_THREAD_COUNTS count (threadMs, median of `repeats`),
+    and speedup compares its best time with fp32's.
+    """
+    if get_model_path(model_key)[0] is None:
+        raise ProcessingError(f"Error: Model file for {model_key} not found")
+    scale = MODELS[model_key]['scale']
+    side = INFERENCE_PROFILE_SIDE // scale
+    reference = _profile_reference(side * scale)
+    image = cv2.resize(reference, (side, side), interpolation=cv2.INTER_AREA)
     
-    if model_path is None:
-        print(f"Error: EDSR model for {scale}x not found", file=sys.stderr)
-        sys.exit(1)
+    profile = {}
+    for precision in INFERENCE_PRECISIONS:
+        if not precision_available(precision):
+            profile[precision] = {"available": False}
+            continue
+        sr = BatchedSuperRes(model_key, precision)
+        output = sr.upsample(image)  # First pass allocates
+        thread_ms = {}
+        for threads in INFERENCE_THREAD_COUNTS:
+            times = []
+            with cv_threads(threads):
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    sr.upsample(image)
+                    times.append((time.perf_counter() - start) * 1000)
+            thread_ms[threads] = sorted(times)[len(times) // 2]
+        best_threads = min(thread_ms, key=thread_ms.get)
+        psnr = cv2.PSNR(output, reference)
+        if precision == 'fp32':
+            fp32_psnr, fp32_ms = psnr, thread_ms[best_threads]
+        profile[precision] = {
+            "available": True,
+            "psnrDb": round(psnr, 2),
+            "psnrDeltaDb": round(psnr - fp32_psnr, 2),
+            "threadMs": {str(threads): round(ms, 1) for threads, ms in thread_ms.items()},
+            "bestThreads": best_threads,
+            "speedup": round(fp32_ms / thread_ms[best_threads], 2)
+        }
+        print(f"  {precision}: {psnr:.2f}dB ({psnr - fp32_psnr:+.2f}), {thread_ms[best_threads]:.1f}ms "
+              f"with {best_threads} threads", file=sys.stderr)
+    profile['profiledAt'] = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    INFERENCE_PROFILES.update(model_key, profile)
+    return profile
+
+# ============== TILE PROFILES ==============
+# Tile geometry per model and scale, tuned on this host with `upscale_script.py --autotune`.
+# The tiling code reads it from TILE_PROFILES and uses DEFAULT_TILE_GEOMETRY for untuned models.
+
+DEFAULT_TILE_GEOMETRY = {'tileSize': 256, 'overlap': 16, 'maxDirectPixels': MAX_DIRECT_PIXELS}
+
+# Square input sides autotune times; the ones up to AUTOTUNE_MAX_TILE are the tile size candidates
+AUTOTUNE_SIDES = (128, 192, 256, 384, 512, 768, 1024)
+AUTOTUNE_MAX_TILE = 512
+AUTOTUNE_OVERLAPS = (4, 8, 16, 24, 32)
+# Input size the tile geometries are compared on
+AUTOTUNE_REFERENCE_SIZE = (1024, 768)
+# Blended tiles must match a one-pass upscale this closely (PSNR, dB) for an overlap to qualify
+AUTOTUNE_SEAM_PSNR = 45.0
+
+def _rss_bytes():
+    """Current resident memory of this process (None where /proc isn't available)
     
-    sr.readModel(model_path)
-    sr.setModel(model_name, scale)
+    Freed heap is handed back first (glibc malloc_trim), so growth measured between two
+    calls is new memory rather than whatever reuse the allocator happened to find.
+    """
+    try:
+        import ctypes
+        ctypes.CDLL(None).malloc_trim(0)
+    except (ImportError, OSError, AttributeError):
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class TileProfiles:
+    """Tile geometry per MODELS key, from a JSON profile written by autotune_tiles
     
-    h, w = image.shape[:2]
+    Tuned profiles also record the inference memory per input pixel, which geometry()
+    uses to keep the tiles in flight (and direct passes) under memory_cap_mb.
+    """
     
-    # If image is small enough, process directly without tiling
-    max_direct_pixels = 512 * 512  # ~262k pixels
-    if h * w <= max_direct_pixels:
-        return sr.upsample(image)
+    def __init__(self, path, memory_cap_mb=1024):
+        self.path = path
+        self.memory_cap_mb = memory_cap_mb
+        self._lock = threading.Lock()
+        self._profiles = _read_json(path)
     
-    # Calculate output dimensions
-    out_h, out_w = h * scale, w * scale
+    def geometry(self, model_key, in_flight=1):
+        """(tile_size, overlap, max_direct_pixels) for model_key with in_flight tiles inferred at once"""
+        with self._lock:
+            profile = {**DEFAULT_TILE_GEOMETRY, **self._profiles.get(model_key, {})}
+        tile_size, overlap, max_direct = profile['tileSize'], profile['overlap'], profile['maxDirectPixels']
+        if profile.get('bytesPerPixel'):
+            fits = self.memory_cap_mb * 1024 * 1024 / profile['bytesPerPixel']  # Input pixels within the cap
+            max_direct = min(max_direct, int(fits))
+            capped = int((fits / max(1, in_flight)) ** 0.5) // 16 * 16
+            tile_size = max(min(tile_size, capped), 2 * overlap + 16)
+        return tile_size, overlap, max_direct
     
-    # Create output canvas
-    result = np.zeros((out_h, out_w, 3), dtype=np.uint8)
-    weight_map = np.zeros((out_h, out_w), dtype=np.float32)
+    def update(self, model_key, profile):
+        """Store a tuned profile for model_key and persist the file"""
+        with self._lock:
+            self._profiles[model_key] = profile
+            snapshot = dict(self._profiles)
+        try:
+            _write_json_atomic(self.path, snapshot, indent=2)
+        except OSError as e:
+            print(f"Warning: Could not save tile profile: {str(e)}", file=sys.stderr)
     
-    # Calculate step size (tile_size - overlap)
-    step = tile_size - overlap
+    def stats(self):
+        with self._lock:
+            return {key: {name: profile.get(name) for name in ('tileSize', 'overlap', 'maxDirectPixels', 'bytesPerPixel')}
+                    for key, profile in self._profiles.items()}
+
+TILE_PROFILES = TileProfiles(os.environ.get('UPSCALE_TILE_PROFILE') or
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tile_profile.json'),
+                             int(os.environ.get('UPSCALE_TILE_MEMORY_MB', 1024)))
+
+def tile_geometry(model_key, tile_size=None, overlap=None, in_flight=1):
+    """(tile_size, overlap, max_direct_pixels): explicit values where given, else the profile's"""
+    profile_tile, profile_overlap, max_direct = TILE_PROFILES.geometry(model_key, in_flight)
+    return tile_size or profile_tile, profile_overlap if overlap is None else overlap, max_direct
+
+def autotune_tiles(model_key, repeats=3):
+    """Time candidate tile geometries for model_key on this host, save the best and return it
     
-    # Process tiles
-    for y in range(0, h, step):
-        for x in range(0, w, step):
-            # Calculate tile boundaries
-            y_end = min(y + tile_size, h)
-            x_end = min(x + tile_size, w)
-            y_start = max(0, y_end - tile_size)
-            x_start = max(0, x_end - tile_size)
-            
-            # Extract tile
-            tile = image[y_start:y_end, x_start:x_end]
-            
-            # Upscale tile
-            upscaled_tile = sr.upsample(tile)
-            
-            # Calculate output positions
-            out_y_start = y_start * scale
-            out_x_start = x_start * scale
-            out_y_end = out_y_start + upscaled_tile.shape[0]
-            out_x_end = out_x_start + upscaled_tile.shape[1]
-            
-            # Create blending weight (feather edges for smooth blending)
-            tile_h, tile_w = upscaled_tile.shape[:2]
-            blend_weight = np.ones((tile_h, tile_w), dtype=np.float32)
-            
-            # Feather the edges
-            feather = overlap * scale
-            if feather > 0:
-                for i in range(feather):
-                    weight = i / feather
-                    if y_start > 0:
-                        blend_weight[i, :] *= weight
-                    if y_end < h:
-                        blend_weight[tile_h - 1 - i, :] *= weight
-                    if x_start > 0:
-                        blend_weight[:, i] *= weight
-                    if x_end < w:
-                        blend_weight[:, tile_w - 1 - i] *= weight
-            
-            # Add to result with blending
-            for c in range(3):
-                result[out_y_start:out_y_end, out_x_start:out_x_end, c] = (
-                    result[out_y_start:out_y_end, out_x_start:out_x_end, c] * 
-                    (1 - blend_weight / (weight_map[out_y_start:out_y_end, out_x_start:out_x_end] + blend_weight + 1e-8)) +
-                    upscaled_tile[:, :, c] * blend_weight / (weight_map[out_y_start:out_y_end, out_x_start:out_x_end] + blend_weight + 1e-8)
-                ).astype(np.uint8)
-            
-            weight_map[out_y_start:out_y_end, out_x_start:out_x_end] += blend_weight
+    A tile's inference time depends only on its size, so each side in AUTOTUNE_SIDES is
+    timed once and geometries are compared by predicted time on AUTOTUNE_REFERENCE_SIZE
+    (tile count x time per tile). The overlap is the smallest whose blended output matches a
+    one-pass upscale to AUTOTUNE_SEAM_PSNR. Inputs up to the largest side that costs no more
+    per pixel than tiling are processed in one pass. Sides whose inference memory would
+    exceed the memory cap are skipped.
+    """
+    if get_model_path(model_key)[0] is None:
+        raise ProcessingError(f"Error: Model file for {model_key} not found")
+    scale = MODELS[model_key]['scale']
+    memory_cap = TILE_PROFILES.memory_cap_mb * 1024 * 1024
+    rng = np.random.RandomState(0)
     
-    return result
-
-def upscale_with_espcn(image, scale=2):
-    """Upscaling using ESPCN model"""
-    sr = dnn_superres.DnnSuperResImpl_create()
+    def sample(height, width):
+        """Textured test input (timing doesn't depend on content, the seam check does)"""
+        coarse = rng.randint(0, 256, (max(2, height // 8), max(2, width // 8), 3)).astype(np.uint8)
+        return cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC)
     
-    model_key = f'espcn_{scale}x'
-    model_path, model_name, _ = get_model_path(model_key)
+    with TileRunner(model_key) as runner:
+        # Memory per input pixel: growth of the engine's first large pass, once the weights are loaded
+        runner.upsample(sample(16, 16))
+        before = _rss_bytes()
+        runner.upsample(sample(256, 256))
+        after = _rss_bytes()
+        bytes_per_pixel = round((after - before) / (256 * 256), 1) if before and after and after > before else None
+        
+        side_ms = {}
+        for side in AUTOTUNE_SIDES:
+            if bytes_per_pixel and side * side * bytes_per_pixel > memory_cap:
+                break
+            image = sample(side, side)
+            runner.upsample(image)  # First pass at a new shape allocates
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                runner.upsample(image)
+                times.append((time.perf_counter() - start) * 1000)
+            side_ms[side] = sorted(times)[len(times) // 2]
+            print(f"  {side}x{side}: {side_ms[side]:.1f}ms", file=sys.stderr)
+            # Past the tile candidates, stop once bigger passes get slower per pixel
+            if side > AUTOTUNE_MAX_TILE and side_ms[side] / side ** 2 > min(ms / s ** 2 for s, ms in side_ms.items()) * 1.1:
+                break
+        if not side_ms:
+            raise ProcessingError(f"Error: No tile size for {model_key} fits in {TILE_PROFILES.memory_cap_mb}MB")
+        
+        # Smallest overlap without visible seams, checked with the smallest tiles (most seams)
+        smallest = min(side_ms)
+        image = sample(smallest * 5 // 2, smallest * 5 // 2)
+        direct = runner.upsample(image)
+        h, w = image.shape[:2]
+        overlap = AUTOTUNE_OVERLAPS[-1]
+        for candidate in AUTOTUNE_OVERLAPS:
+            blender = TileBlender(h, w, scale, candidate, image.shape[2])
+            for box, upscaled_tile in runner.run(image, tile_grid(h, w, smallest, candidate)):
+                blender.add(box, upscaled_tile)
+            if cv2.PSNR(blender.result(), direct) >= AUTOTUNE_SEAM_PSNR:
+                overlap = candidate
+                break
     
-    if model_path is None:
-        # Fallback to FSRCNN
-        return upscale_lite(image, scale)
+    ref_w, ref_h = AUTOTUNE_REFERENCE_SIZE
+    predicted = {side: len(tile_grid(ref_h, ref_w, side, overlap)) * ms
+                 for side, ms in side_ms.items() if side <= AUTOTUNE_MAX_TILE and side > 2 * overlap}
+    tile_size = min(predicted, key=predicted.get)
+    tiled_ms_per_pixel = predicted[tile_size] / (ref_w * ref_h)
+    direct_side = max([side for side, ms in side_ms.items() if ms / side ** 2 <= tiled_ms_per_pixel] or [tile_size])
     
-    sr.readModel(model_path)
-    sr.setModel(model_name, scale)
-    return sr.upsample(image)
+    profile = {
+        "tileSize": tile_size,
+        "overlap": overlap,
+        "maxDirectPixels": direct_side * direct_side,
+        "bytesPerPixel": bytes_per_pixel,
+        "msPerInputMegapixel": round(tiled_ms_per_pixel * 1e6, 1),
+        "sideMs": {str(side): round(ms, 1) for side, ms in side_ms.items()},
+        "tunedAt": time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    }
+    TILE_PROFILES.update(model_key, profile)
+    return profile
 
-def upscale_image(input_path, output_path, options):
-    """Upscale image using selected model type"""
-    scale_str = options.get('model', '2x')
-    scale = int(scale_str.replace('x', ''))
-    model_type = options.get('modelType', 'realesrgan-fast')  # Default to Real-ESRGAN fast
-    tier = options.get('tier', 'free')  # 'free', 'pro', 'business'
+def upscale_with_tiling(image, scale=2, tile_size=None, overlap=None, workers=1, pool='thread', batch_size=1,
+                        flat_threshold=None, on_progress=None, model_key=None):
+    """High-quality upscaling using EDSR with tiling (Pro mode)
+    Processes image in tiles to prevent RAM overflow on weak servers
     
-    image = cv2.imread(input_path)
-    if image is None:
-        print("Error: Could not read image", file=sys.stderr)
-        sys.exit(1)
+    With workers > 1 the tiles are spread over a thread or process pool
+    (pool='thread'|'process'), each worker with its own network. Output is identical
+    to the serial path. With batch_size > 1, equal-sized tiles go through the
+    network batch_size at a time (BatchedSuperRes). Geometry not given comes from TILE_PROFILES.
+    With flat_threshold set (hybrid tiling), flat tiles are upscaled with Lanczos instead.
+    on_progress(done, total, 'tiles') is called each time another row's worth of tiles is in.
+    model_key runs another MODELS network of the same scale instead of EDSR.
+    """
+    model_key = model_key or f'edsr_{scale}x'
+    if get_model_path(model_key)[0] is None:
+        raise ProcessingError(f"Error: {MODELS[model_key]['name'].upper()} model for {scale}x not found")
+    tile_size, overlap, max_direct = tile_geometry(model_key, tile_size, overlap, workers * batch_size)
     
     h, w = image.shape[:2]
-    print(f"Input image: {w}x{h}", file=sys.stderr)
+    with TileRunner(model_key, workers, pool, batch_size, flat_threshold) as runner:
+        if h * w <= max_direct:
+            return runner.upsample(image)
+        
+        boxes = tile_grid(h, w, tile_size, overlap)
+        if current_metrics() is not None:
+            current_metrics().set_tiling(boxes, tile_size, overlap)
+        blender = TileBlender(h, w, scale, overlap, image.shape[2])
+        row_tiles = len({box[2] for box in boxes})
+        for done, (box, upscaled_tile) in enumerate(runner.run(image, boxes), 1):
+            with timed('blend'):
+                blender.add(box, upscaled_tile)
+            if on_progress is not None and (done % row_tiles == 0 or done == len(boxes)):
+                on_progress(done, len(boxes), 'tiles')
     
-    # Select model based on modelType parameter
-    if model_type == 'realesrgan':
-        # Real-ESRGAN - Best quality (Pro users) - only supports 4x
-        print(f"Using Real-ESRGAN (Best Quality) for {scale}x upscale", file=sys.stderr)
-        # realesrgan-x4plus only supports 4x, so we upscale to 4x and resize if needed
-        success = upscale_with_realesrgan(input_path, output_path, 4, 'realesrgan-x4plus')
-        if success:
-            result = cv2.imread(output_path)
-            # If user requested 2x, resize the 4x result down to 2x
-            if scale == 2:
-                h_out, w_out = result.shape[:2]
-                result = cv2.resize(result, (w_out // 2, h_out // 2), interpolation=cv2.INTER_AREA)
-                cv2.imwrite(output_path, result)
-            model_used = 'realesrgan'
-        else:
-            # Fallback to EDSR
-            print("Falling back to EDSR...", file=sys.stderr)
-            result = upscale_with_tiling(image, scale)
-            cv2.imwrite(output_path, result)
-            model_used = 'edsr'
-    
-    elif model_type == 'realesrgan-fast':
-        # Real-ESRGAN Fast - Good quality, fast (Free users)
-        print(f"Using Real-ESRGAN Fast for {scale}x upscale", file=sys.stderr)
-        success = upscale_with_realesrgan(input_path, output_path, scale, f'realesr-animevideov3-x{scale}')
-        if success:
-            result = cv2.imread(output_path)
-            model_used = 'realesrgan-fast'
-        else:
-            # Fallback to Lanczos (better than FSRCNN)
-            print("Falling back to Lanczos interpolation...", file=sys.stderr)
-            result = cv2.resize(image, (w * scale, h * scale), interpolation=cv2.INTER_LANCZOS4)
-            cv2.imwrite(output_path, result)
-            model_used = 'lanczos'
-    
-    elif model_type == 'realesrgan-anime':
-        # Real-ESRGAN Anime - Best for anime/art
-        print(f"Using Real-ESRGAN Anime for {scale}x upscale", file=sys.stderr)
-        success = upscale_with_realesrgan(input_path, output_path, 4, 'realesrgan-x4plus-anime')
-        if success:
-            result = cv2.imread(output_path)
-            # If scale is 2x, resize down
-            if scale == 2:
-                h_out, w_out = result.shape[:2]
-                result = cv2.resize(result, (w_out // 2, h_out // 2), interpolation=cv2.INTER_AREA)
-                cv2.imwrite(output_path, result)
-            model_used = 'realesrgan-anime'
-        else:
-            result = upscale_with_tiling(image, scale)
-            cv2.imwrite(output_path, result)
-            model_used = 'edsr'
+    with timed('blend'):
+        return blender.result()
+
+def upscale_with_tiling_to_file(image, output_path, scale=2, tile_size=None, overlap=None, workers=1,
+                                pool='thread', batch_size=1, flat_threshold=None, on_progress=None,
+                                quality=None, preset='balanced', model_key=None):
+    """upscale_with_tiling that streams the output to output_path band by band
     
-    elif model_type == 'edsr':
-        # EDSR - Legacy high quality
-        print(f"Using EDSR (Legacy) for {scale}x upscale", file=sys.stderr)
-        result = upscale_with_tiling(image, scale)
-        cv2.imwrite(output_path, result)
-        model_used = 'edsr'
+    Tiles are processed one row of tiles at a time and finished output rows are handed
+    to a row writer (see open_row_writer). For PNG output peak memory is bounded by one
+    band (tile_size * scale rows) rather than the whole output; other formats collect
+    the rows in a disk-backed memmap and are encoded whole at the end.
+    Returns ((out_h, out_w), encode stats).
+    on_progress(done, total, 'bands') is called as each band is written.
+    """
+    model_key = model_key or f'edsr_{scale}x'
+    if get_model_path(model_key)[0] is None:
+        raise ProcessingError(f"Error: {MODELS[model_key]['name'].upper()} model for {scale}x not found")
+    tile_size, overlap, max_direct = tile_geometry(model_key, tile_size, overlap, workers * batch_size)
     
-    else:
-        # Default: Use Real-ESRGAN Fast for best results
-        print(f"Using Real-ESRGAN Fast (default) for {scale}x upscale", file=sys.stderr)
-        success = upscale_with_realesrgan(input_path, output_path, scale, f'realesr-animevideov3-x{scale}')
-        if success:
-            result = cv2.imread(output_path)
-            model_used = 'realesrgan-fast'
+    h, w = image.shape[:2]
+    channels = image.shape[2]
+    with TileRunner(model_key, workers, pool, batch_size, flat_threshold) as runner, \
+            open_row_writer(output_path, w * scale, h * scale, channels, quality, preset) as writer:
+        if h * w <= max_direct:
+            result = runner.upsample(image)
+            with timed('encode'):
+                writer.write_rows(result)
         else:
-            result = cv2.resize(image, (w * scale, h * scale), interpolation=cv2.INTER_LANCZOS4)
-            cv2.imwrite(output_path, result)
-            model_used = 'lanczos'
+            boxes = tile_grid(h, w, tile_size, overlap)
+            if current_metrics() is not None:
+                current_metrics().set_tiling(boxes, tile_size, overlap)
+            bands = sorted({(y_start, y_end) for y_start, y_end, _, _ in boxes})
+            blender = TileBlender(h, w, scale, overlap, channels, band_rows=min(tile_size, h) * scale)
+            for i, (y_start, y_end) in enumerate(bands):
+                band_boxes = [box for box in boxes if box[0] == y_start]
+                for box, upscaled_tile in runner.run(image, band_boxes):
+                    with timed('blend'):
+                        blender.add(box, upscaled_tile)
+                # Rows above the next band's first tile won't receive any more tiles
+                finished = bands[i + 1][0] * scale if i + 1 < len(bands) else h * scale
+                with timed('blend'):
+                    rows = blender.flush(finished)
+                with timed('encode'):
+                    writer.write_rows(rows)
+                if on_progress is not None:
+                    on_progress(i + 1, len(bands), 'bands')
     
-    # Return info about the result
-    out_h, out_w = result.shape[:2]
-    print(json.dumps({
-        "width": out_w, 
-        "height": out_h, 
-        "scale": scale,
-        "model": model_used,
-        "tier": tier
-    }))
+    return (h * scale, w * scale), writer.stats
 
-def resize_image(input_path, output_path, options):
-    """Resize image by pixels or percentage"""
-    image = cv2.imread(input_path)
-    if image is None:
-        print("Error: Could not read image", file=sys.stderr)
-        sys.exit(1)
+# Feather weights are whole numbers out of FEATHER_LEVELS. Every tile * mask product is
+# then an integer below 2^24, so float32 sums are exact and don't depend on the order
+# tiles are added in (parallel tiling gives the same output as serial).
+FEATHER_LEVELS = 64
+
+@lru_cache(maxsize=None)
+def feather_ramp(length):
+    """Blend weights rising from 0 to just under FEATHER_LEVELS over `length` pixels"""
+    ramp = np.round(np.arange(length) * FEATHER_LEVELS / length).astype(np.float32)
+    ramp.flags.writeable = False
+    return ramp
+
+def _edge_profile(length, feather, fade_start, fade_end):
+    """1-D weights along one tile axis, faded in/out on the sides that overlap a neighbour"""
+    profile = np.full(length, FEATHER_LEVELS, dtype=np.float32)
+    n = min(feather, length)
+    if n > 0:
+        ramp = feather_ramp(feather)[:n]
+        if fade_start:
+            profile[:n] = np.minimum(profile[:n], ramp)
+        if fade_end:
+            profile[length - n:] = np.minimum(profile[length - n:], ramp[::-1])
+    return profile
+
+@lru_cache(maxsize=64)
+def feather_mask(tile_h, tile_w, feather, top, bottom, left, right, channels=3):
+    """Blend mask for one tile, built by broadcasting the row and column profiles
     
-    original_h, original_w = image.shape[:2]
+    Returns (mask, per_channel) where mask is (tile_h, tile_w) and per_channel repeats it
+    for every image channel. Interior tiles share a shape and edge flags, so these are
+    built once per job.
+    """
+    rows = _edge_profile(tile_h, feather, top, bottom)
+    cols = _edge_profile(tile_w, feather, left, right)
+    mask = rows[:, None] * cols[None, :]
+    per_channel = np.repeat(mask[:, :, None], channels, axis=2)
+    mask.flags.writeable = False
+    per_channel.flags.writeable = False
+    return mask, per_channel
+
+def tile_grid(h, w, tile_size=256, overlap=16):
+    """Input-space (y_start, y_end, x_start, x_end) boxes covering an h x w image
     
-    resize_type = options.get('resizeType', 'percentage')
-    maintain_aspect = options.get('maintainAspect', True)
+    Edge tiles are shifted back inside the image so every tile is full size when the
+    image allows it; a box repeated by that shift is only returned once.
+    """
+    step = tile_size - overlap
+    ys = sorted({(max(0, min(y + tile_size, h) - tile_size), min(y + tile_size, h)) for y in range(0, h, step)})
+    xs = sorted({(max(0, min(x + tile_size, w) - tile_size), min(x + tile_size, w)) for x in range(0, w, step)})
+    return [(y_start, y_end, x_start, x_end) for y_start, y_end in ys for x_start, x_end in xs]
+
+# Hybrid tiling sends a tile to Lanczos when no 16x16 block in it has a mean absolute
+# grayscale Laplacian above this. Codec noise and smooth gradients stay under it; an edge
+# or a text stroke anywhere in the tile goes far over.
+DEFAULT_FLAT_TILE_THRESHOLD = 4.0
+
+def tile_complexity(tile):
+    """Largest 16x16-block mean of the absolute grayscale Laplacian of a tile
     
-    if resize_type == 'percentage':
-        percentage = options.get('percentage', 100)
-        new_w = int(original_w * percentage / 100)
-        new_h = int(original_h * percentage / 100)
-    else:  # pixels
-        new_w = options.get('width', original_w)
-        new_h = options.get('height', original_h)
-        
-        if maintain_aspect:
-            # Calculate aspect ratio and adjust
-            aspect = original_w / original_h
-            if new_w / new_h > aspect:
-                new_w = int(new_h * aspect)
-            else:
-                new_h = int(new_w / aspect)
+    Scoring the busiest block rather than the whole tile keeps a mostly empty tile
+    with a line of text in it on the network.
+    """
+    gray = cv2.cvtColor(tile, cv2.COLOR_BGR2GRAY) if tile.ndim == 3 and tile.shape[2] == 3 else tile
+    if gray.ndim == 3:
+        gray = gray[:, :, 0]
+    laplacian = np.abs(cv2.Laplacian(gray, cv2.CV_16S)).astype(np.float32)
+    h, w = gray.shape
+    return float(cv2.resize(laplacian, (max(1, w // 16), max(1, h // 16)), interpolation=cv2.INTER_AREA).max())
+
+def tile_batches(boxes, batch_size=1):
+    """Group tile boxes into lists of up to batch_size boxes that share a tile shape"""
+    by_shape = OrderedDict()
+    for box in boxes:
+        y_start, y_end, x_start, x_end = box
+        by_shape.setdefault((y_end - y_start, x_end - x_start), []).append(box)
+    return [group[i:i + batch_size]
+            for group in by_shape.values()
+            for i in range(0, len(group), max(1, batch_size))]
+
+def crop_tiles(image, boxes):
+    return [image[y_start:y_end, x_start:x_end] for y_start, y_end, x_start, x_end in boxes]
+
+class TileBlender:
+    """Accumulates feathered, upscaled tiles into a float32 canvas and normalizes once at the end
     
-    # Ensure minimum dimensions
-    new_w = max(1, new_w)
-    new_h = max(1, new_h)
+    With band_rows set, only that many output rows are held at a time: tiles must then
+    arrive top to bottom, and flush() takes finished rows off the top of the band.
+    """
     
-    # Choose interpolation method based on scaling direction
-    if new_w < original_w or new_h < original_h:
-        interpolation = cv2.INTER_AREA  # Better for shrinking
-    else:
-        interpolation = cv2.INTER_CUBIC  # Better for enlarging
+    def __init__(self, h, w, scale, overlap, channels=3, band_rows=None):
+        self.h, self.w, self.scale, self.channels = h, w, scale, channels
+        self.feather = overlap * scale
+        self.top = 0  # Output row held at index 0 of the canvas
+        rows = h * scale if band_rows is None else band_rows
+        self.sums = np.zeros((rows, w * scale, channels), dtype=np.float32)
+        self.weights = np.zeros((rows, w * scale), dtype=np.float32)
     
-    result = cv2.resize(image, (new_w, new_h), interpolation=interpolation)
+    def add(self, box, upscaled_tile):
+        """Blend in the upscaled version of the input-space tile `box` (any order is fine)"""
+        y_start, y_end, x_start, x_end = box
+        tile_h, tile_w = upscaled_tile.shape[:2]
+        out_y, out_x = y_start * self.scale - self.top, x_start * self.scale
+        if out_y < 0 or out_y + tile_h > len(self.sums):
+            raise ValueError(f"Tile at row {y_start} is outside the current band")
+        mask, per_channel = feather_mask(tile_h, tile_w, self.feather,
+                                         y_start > 0, y_end < self.h, x_start > 0, x_end < self.w,
+                                         self.channels)
+        # cv2 accumulates in place on the canvas views, across all channels in one call
+        cv2.accumulateProduct(upscaled_tile.astype(np.float32), per_channel,
+                              self.sums[out_y:out_y + tile_h, out_x:out_x + tile_w])
+        cv2.accumulate(mask, self.weights[out_y:out_y + tile_h, out_x:out_x + tile_w])
     
-    # Get quality setting
-    quality = options.get('quality', 90)
+    def _normalize(self, sums, weights):
+        np.maximum(weights, 1e-8, out=weights)
+        return cv2.divide(sums, cv2.merge([weights] * self.channels), dtype=cv2.CV_8U)
     
-    # Determine output format from extension
-    ext = os.path.splitext(output_path)[1].lower()
-    if ext in ['.jpg', '.jpeg']:
-        cv2.imwrite(output_path, result, [cv2.IMWRITE_JPEG_QUALITY, quality])
-    elif ext == '.png':
-        compression = int((100 - quality) / 10)  # Convert quality to PNG compression (0-9)
-        cv2.imwrite(output_path, result, [cv2.IMWRITE_PNG_COMPRESSION, compression])
-    elif ext == '.webp':
-        cv2.imwrite(output_path, result, [cv2.IMWRITE_WEBP_QUALITY, quality])
-    else:
-        cv2.imwrite(output_path, result)
+    def flush(self, until):
+        """Weighted average of output rows top..until as uint8, then slide the band down past them"""
+        n = until - self.top
+        if n <= 0:
+            return np.zeros((0, self.sums.shape[1], self.channels), dtype=np.uint8)
+        rows = self._normalize(self.sums[:n], self.weights[:n])
+        self.sums[:-n or None] = self.sums[n:]
+        self.weights[:-n or None] = self.weights[n:]
+        self.sums[len(self.sums) - n:] = 0
+        self.weights[len(self.weights) - n:] = 0
+        self.top = until
+        return rows
     
-    print(json.dumps({
-        "width": new_w, 
-        "height": new_h,
-        "originalWidth": original_w,
-        "originalHeight": original_h
-    }))
+    def result(self):
+        """Weighted average of everything added, rounded to uint8"""
+        return self._normalize(self.sums, self.weights)
 
-try:
-    if mode == 'upscale':
-        upscale_image(input_path, output_path, options)
-    elif mode == 'resize':
-        resize_image(input_path, output_path, options)
-    else:
-        print(f"Unknown mode: {mode}", file=sys.stderr)
-        sys.exit(1)
+# OpenCV's thread count is process-wide, so cv_threads blocks in concurrent jobs share it
+_cv_threads_lock = threading.Lock()
+_cv_threads_state = {"active": 0, "baseline": None}
+
+@contextmanager
+def cv_threads(count):
+    """Set OpenCV's own thread count while the block runs
     
-    print("Done", file=sys.stderr)
+    Blocks can overlap (concurrent worker jobs): the most recent count applies until every
+    one of them has exited, and only then is the count from before the first one restored.
+    Saving and restoring per block instead could leave the process on some job's count for good.
+    """
+    with _cv_threads_lock:
+        if _cv_threads_state['active'] == 0:
+            _cv_threads_state['baseline'] = cv2.getNumThreads()
+        _cv_threads_state['active'] += 1
+        cv2.setNumThreads(count)
+    try:
+        yield
+    finally:
+        with _cv_threads_lock:
+            _cv_threads_state['active'] -= 1
+            if _cv_threads_state['active'] == 0:
+                cv2.setNumThreads(_cv_threads_state['baseline'])
+
+def tile_key(model_key, engine, precision, tile):
+    """Hash of a tile's pixels and shape plus the network (and precision) that upscales it"""
+    digest = hashlib.blake2b(np.ascontiguousarray(tile), digest_size=16)
+    digest.update(repr((model_key, engine, precision, tile.shape)).encode('utf-8'))
+    return digest.digest()
+
+class TileCache:
+    """Size-bounded LRU of upscaled tiles keyed by tile_key
+    
+    Stored tiles are made read-only and handed out as they are, so one array can be
+    blended into several places (or jobs) without copying.
+    """
+    
+    def __init__(self, max_size_mb=256):
+        self.max_bytes = max_size_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> upscaled tile, least recently used first
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+    
+    def get(self, key):
+        with self._lock:
+            tile = self._entries.get(key)
+            if tile is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return tile
+    
+    def put(self, key, tile):
+        if tile.nbytes > self.max_bytes:
+            return
+        tile.flags.writeable = False
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.nbytes
+            self._entries[key] = tile
+            self._bytes += tile.nbytes
+            self._stats['stores'] += 1
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self._stats['evictions'] += 1
+    
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                "hitRatio": round(self._stats['hits'] / lookups, 4) if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "maxBytes": self.max_bytes
+            }
+
+# Upscaled tiles a job keeps for its later bands (streamed output runs tiles a band at a time)
+JOB_TILE_CACHE_MB = 32
+
+# Set by the worker (--tile-cache-mb) to reuse upscaled tiles across jobs
+TILE_CACHE = None
+
+# Network for the current tile process (see TileRunner)
+_process_sr = None
+
+def _init_tile_process(model_key, engine, precision, cv_thread_count):
+    global _process_sr
+    cv2.setNumThreads(cv_thread_count)
+    _process_sr = MODEL_REGISTRY.checkout(model_key, engine, precision)
+
+def _upsample_in_process(tiles):
+    """Upscale tiles with this process's network; returns (tiles, elapsed_ms)"""
+    start = time.perf_counter()
+    results = upsample_tiles(_process_sr, tiles)
+    return results, (time.perf_counter() - start) * 1000
+
+class TileRunner:
+    """Runs tiles through a MODELS network, serially or spread over a pool
+    
+    Use as a context manager. With workers > 1 the tiles go to a 'thread' or 'process'
+    pool with one network per worker and results come back in completion order. While the
+    pool exists OpenCV's internal thread count is divided between the workers (cv_threads,
+    shared with any other job doing the same) so the pool doesn't oversubscribe the CPU.
+    The pool is created on first use and kept until exit.
+    With flat_threshold set, tiles whose tile_complexity is at or under it are upscaled
+    with Lanczos in the calling thread and only the rest go to the network. Tiles with
+    identical pixels go through the network once per job, and not at all if TILE_CACHE
+    already has them. The network runs at the current job's inference_precision.
+    """
+    
+    def __init__(self, model_key, workers=1, pool='thread', batch_size=1, flat_threshold=None):
+        if pool not in ('thread', 'process'):
+            raise ProcessingError(f"Unknown tile pool: {pool}")
+        self.model_key = model_key
+        self.workers = max(1, workers)
+        self.pool = pool
+        self.batch_size = max(1, batch_size)
+        self.engine = 'batched' if self.batch_size > 1 else 'superres'
+        self.precision = inference_precision(model_key)
+        self.flat_threshold = flat_threshold
+        self.tile_cache = TileCache(JOB_TILE_CACHE_MB)
+        self._executor = None
+        self._local = threading.local()
+        self._checked_out = []
+        self._lock = threading.Lock()
+        self._threads = ExitStack()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._threads.close()
+        for sr in self._checked_out:
+            MODEL_REGISTRY.checkin(self.model_key, sr, self.engine, self.precision)
+        self._checked_out = []
+    
+    def _sr(self):
+        """This thread's network, checked out on first use"""
+        sr = getattr(self._local, 'sr', None)
+        if sr is None:
+            sr = self._local.sr = MODEL_REGISTRY.checkout(self.model_key, self.engine, self.precision)
+            if sr is None:
+                raise ProcessingError(f"Error: Model file for {self.model_key} not found")
+            with self._lock:
+                self._checked_out.append(sr)
+        return sr
+    
+    def _upsample_tiles(self, tiles):
+        sr = self._sr()
+        start = time.perf_counter()
+        results = upsample_tiles(sr, tiles)
+        if current_metrics() is not None:
+            current_metrics().add_tiles((time.perf_counter() - start) * 1000, len(tiles))
+        return results
+    
+    def upsample(self, image):
+        """Upscale a whole image in the calling thread
+        
+        In a worker with an INFERENCE_BATCHER the image is batched with same-sized images
+        from concurrent jobs instead.
+        """
+        with timed('inference'):
+            if INFERENCE_BATCHER is not None:
+                return INFERENCE_BATCHER.upsample(self.model_key, image, self.precision)
+            return self._sr().upsample(image)
+    
+    def run(self, image, boxes):
+        """Yield (box, upscaled_tile) for every input-space box, in completion order"""
+        if self.flat_threshold is not None:
+            scale = MODELS[self.model_key]['scale']
+            flat, detailed = [], []
+            # Scoring counts as resize time along with the Lanczos tiles themselves
+            with timed('resize'):
+                for box, tile in zip(boxes, crop_tiles(image, boxes)):
+                    (flat if tile_complexity(tile) <= self.flat_threshold else detailed).append(box)
+            if current_metrics() is not None:
+                current_metrics().add_tile_paths(len(detailed), len(flat))
+            for box, tile in zip(flat, crop_tiles(image, flat)):
+                with timed('resize'):
+                    upscaled_tile = cv2.resize(tile, (tile.shape[1] * scale, tile.shape[0] * scale),
+                                               interpolation=cv2.INTER_LANCZOS4)
+                yield box, upscaled_tile
+            boxes = detailed
+        
+        # Group identical tiles; each group needs one upscaled tile, from a cache or the network
+        groups = OrderedDict()  # tile key -> boxes with those pixels
+        for box, tile in zip(boxes, crop_tiles(image, boxes)):
+            groups.setdefault(tile_key(self.model_key, self.engine, self.precision, tile), []).append(box)
+        job_hits = len(boxes) - len(groups)
+        shared_hits = 0
+        pending = {}  # First box of each group still to run -> its key
+        for key, same in groups.items():
+            upscaled_tile = self.tile_cache.get(key)
+            if upscaled_tile is None and TILE_CACHE is not None:
+                upscaled_tile = TILE_CACHE.get(key)
+                if upscaled_tile is not None:
+                    self.tile_cache.put(key, upscaled_tile)
+                    shared_hits += 1
+            elif upscaled_tile is not None:
+                job_hits += 1
+            if upscaled_tile is None:
+                pending[same[0]] = key
+                continue
+            for box in same:
+                yield box, upscaled_tile
+        if current_metrics() is not None:
+            current_metrics().add_tile_dedup(len(pending), job_hits, shared_hits)
+        
+        for box, upscaled_tile in self._run_network(image, list(pending)):
+            key = pending[box]
+            self.tile_cache.put(key, upscaled_tile)
+            if TILE_CACHE is not None:
+                TILE_CACHE.put(key, upscaled_tile)
+            for same in groups[key]:
+                yield same, upscaled_tile
+    
+    def _run_network(self, image, boxes):
+        """Yield (box, upscaled_tile) for boxes run through the network, in completion order"""
+        batches = tile_batches(boxes, self.batch_size)
+        if not batches:
+            return
+        if self.workers == 1 or len(batches) == 1:
+            for batch in batches:
+                yield from zip(batch, self._upsample_tiles(crop_tiles(image, batch)))
+            return
+        
+        if self._executor is None:
+            cv_thread_count = max(1, (os.cpu_count() or 1) // self.workers)
+            self._threads.enter_context(cv_threads(cv_thread_count))
+            if self.pool == 'process':
+                self._executor = ProcessPoolExecutor(self.workers, initializer=_init_tile_process,
+                                                     initargs=(self.model_key, self.engine, self.precision,
+                                                               cv_thread_count))
+            else:
+                self._executor = ThreadPoolExecutor(self.workers)
+        
+        if self.pool == 'process':
+            futures = {self._executor.submit(_upsample_in_process, crop_tiles(image, batch)): batch for batch in batches}
+        else:
+            # Each thread job runs in a copy of our context so its timings land on this job
+            futures = {self._executor.submit(contextvars.copy_context().run, self._upsample_tiles, crop_tiles(image, batch)): batch
+                       for batch in batches}
+        for future in as_completed(futures):
+            results = future.result()
+            if self.pool == 'process':
+                results, elapsed_ms = results
+                if current_metrics() is not None:
+                    current_metrics().add_tiles(elapsed_ms, len(results))
+            yield from zip(futures[future], results)
+
+# ============== ENCODING ==============
+# Every output goes through encode_image: cv2.imencode into memory with a named preset, so
+# the bytes can be written, streamed or cached as they are and the encode cost is reported.
+
+ENCODE_PRESETS = ('fast', 'balanced', 'smallest')
+
+# Output extension -> format name used in results and ENCODER_PRESETS
+ENCODE_FORMATS = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.png': 'png', '.webp': 'webp'}
+
+# cv2.imencode params per format and preset. A preset with several candidates encodes with
+# each and keeps the smallest (which PNG strategy wins depends on the content).
+ENCODER_PRESETS = {
+    'jpeg': {
+        'fast': [[cv2.IMWRITE_JPEG_OPTIMIZE, 0]],
+        'balanced': [[cv2.IMWRITE_JPEG_OPTIMIZE, 1]],  # Optimized Huffman tables: ~8% smaller, same pixels
+        'smallest': [[cv2.IMWRITE_JPEG_OPTIMIZE, 1, cv2.IMWRITE_JPEG_PROGRESSIVE, 1],
+                     [cv2.IMWRITE_JPEG_OPTIMIZE, 1]],  # Progressive only pays off on larger images
+    },
+    'png': {
+        'fast': [[]],  # Without a compression level cv2 tunes for speed (level 1, SUB filter, RLE)
+        'balanced': [[cv2.IMWRITE_PNG_COMPRESSION, 6, cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE]],
+        'smallest': [[cv2.IMWRITE_PNG_COMPRESSION, 9, cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE],
+                     [cv2.IMWRITE_PNG_COMPRESSION, 9, cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_FILTERED]],
+    },
+    # cv2's WebP encoder only takes a quality (libwebp's method level isn't exposed), so presets are the same
+    'webp': {'fast': [[]], 'balanced': [[]], 'smallest': [[]]},
+}
+
+# (zlib level, strategy) for PngRowWriter, which always uses the Paeth filter
+STREAMED_PNG_SETTINGS = {'fast': (1, zlib.Z_RLE), 'balanced': (6, zlib.Z_RLE), 'smallest': (9, zlib.Z_DEFAULT_STRATEGY)}
+
+QUALITY_PARAMS = {'jpeg': cv2.IMWRITE_JPEG_QUALITY, 'webp': cv2.IMWRITE_WEBP_QUALITY}
+
+def encode_preset(options):
+    """options['encodePreset'], checked (default 'balanced')"""
+    preset = options.get('encodePreset') or 'balanced'
+    if preset not in ENCODE_PRESETS:
+        raise ProcessingError(f"Error: Unknown encodePreset '{preset}' (use {', '.join(ENCODE_PRESETS)})")
+    return preset
+
+def encode_image(image, ext, quality=None, preset='balanced'):
+    """Encode image for the ext format in memory: returns (encoded bytes as a uint8 array, stats)
+    
+    quality applies to JPEG and WebP (None keeps cv2's defaults: JPEG 95, lossless WebP);
+    PNG is lossless and its effort comes from the preset alone. stats is
+    {format, preset, quality, bytes, encodeMs}.
+    """
+    ext = ext.lower()
+    image_format = ENCODE_FORMATS.get(ext, ext.lstrip('.'))
+    candidates = ENCODER_PRESETS.get(image_format, {}).get(preset, [[]])
+    quality_params = []
+    if quality is not None and image_format in QUALITY_PARAMS:
+        quality_params = [QUALITY_PARAMS[image_format], int(quality)]
+    
+    start = time.perf_counter()
+    with timed('encode'):
+        encoded = None
+        for params in candidates:
+            ok, buffer = cv2.imencode(ext, image, quality_params + params)
+            if ok and (encoded is None or len(buffer) < len(encoded)):
+                encoded = buffer
+    if encoded is None:
+        raise ProcessingError(f"Error: Could not encode {ext} output")
+    return encoded, {
+        "format": image_format,
+        "preset": preset,
+        "quality": quality_params[1] if quality_params else None,
+        "bytes": len(encoded),
+        "encodeMs": round((time.perf_counter() - start) * 1000, 1)
+    }
+
+def write_image(path, image, quality=None, preset='balanced'):
+    """encode_image into a file (or an OutputBuffer), returning the encode stats"""
+    if isinstance(path, OutputBuffer):
+        encoded, stats = encode_image(image, path.ext, quality, preset)
+        path.data = encoded.tobytes()
+        return stats
+    encoded, stats = encode_image(image, os.path.splitext(path)[1], quality, preset)
+    with timed('encode'), open(path, 'wb') as f:
+        f.write(encoded)
+    return stats
+
+# ============== STREAMED OUTPUT ==============
+# Row writers take finished rows top to bottom (write_rows) and produce the output file
+# on close, so very large upscales never hold the whole output in memory.
+
+class PngRowWriter:
+    """Streaming PNG encoder: rows are filtered, deflated and written as they arrive"""
+    
+    COLOR_TYPES = {1: 0, 3: 2, 4: 6}  # Channels -> PNG colour type (gray, RGB, RGBA)
+    
+    def __init__(self, path, width, height, channels=3, preset='balanced'):
+        self.file = open(path, 'wb')
+        self.channels = channels
+        self.preset = preset
+        self.encode_ms = 0.0
+        level, strategy = STREAMED_PNG_SETTINGS[preset]
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 8, strategy)
+        self.previous = np.zeros((1, width, channels), dtype=np.int16)  # Row above the next one
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, self.COLOR_TYPES[channels], 0, 0, 0))
+    
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)) + kind + data)
+        self.file.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    
+    def write_rows(self, rows):
+        if len(rows) == 0:
+            return
+        start = time.perf_counter()
+        if rows.ndim == 2:
+            rows = rows[:, :, None]
+        if self.channels >= 3:
+            rows = cv2.cvtColor(rows, cv2.COLOR_BGR2RGB if self.channels == 3 else cv2.COLOR_BGRA2RGBA)
+        
+        # Paeth filter, computed for the whole band at once from the unfiltered neighbours
+        current = rows.astype(np.int16)
+        up = np.concatenate([self.previous, current[:-1]])
+        left = np.zeros_like(current)
+        left[:, 1:] = current[:, :-1]
+        up_left = np.zeros_like(current)
+        up_left[:, 1:] = up[:, :-1]
+        estimate = left + up - up_left
+        pa, pb, pc = np.abs(estimate - left), np.abs(estimate - up), np.abs(estimate - up_left)
+        predictor = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+        filtered = ((current - predictor) & 0xff).astype(np.uint8).reshape(len(rows), -1)
+        self.previous = current[-1:]
+        
+        scanlines = np.empty((len(rows), filtered.shape[1] + 1), dtype=np.uint8)
+        scanlines[:, 0] = 4  # Paeth filter type
+        scanlines[:, 1:] = filtered
+        data = self.compressor.compress(scanlines.tobytes())
+        if data:
+            self._chunk(b'IDAT', data)
+        self.encode_ms += (time.perf_counter() - start) * 1000
+    
+    def close(self):
+        """Finish the file and return encode stats like encode_image's"""
+        self._chunk(b'IDAT', self.compressor.flush())
+        self._chunk(b'IEND', b'')
+        size = self.file.tell()
+        self.file.close()
+        return {"format": "png", "preset": self.preset, "quality": None, "bytes": size,
+                "encodeMs": round(self.encode_ms, 1)}
+    
+    def abort(self):
+        self.file.close()
+
+class MemmapRowWriter:
+    """Rows go into a disk-backed memmap next to the output, encoded with write_image on close
+    
+    For formats without a streaming encoder here (JPEG, WebP, BMP, ...). The pages are
+    file-backed, so the OS can drop them while the bands come in, but the encode on close
+    reads the whole frame and holds the whole encoded file: memory is only band-bounded
+    until then. OpenCV has no incremental JPEG encoder, so JPEG output can't stream.
+    """
+    
+    def __init__(self, path, width, height, channels=3, quality=None, preset='balanced'):
+        self.path = path
+        self.quality = quality
+        self.preset = preset
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, self.raw_path = tempfile.mkstemp(suffix='.raw', dir=directory)
+        os.close(handle)
+        self.canvas = np.memmap(self.raw_path, dtype=np.uint8, mode='w+', shape=(height, width, channels))
+        self.row = 0
+    
+    def write_rows(self, rows):
+        self.canvas[self.row:self.row + len(rows)] = rows.reshape(len(rows), *self.canvas.shape[1:])
+        self.row += len(rows)
+    
+    def close(self):
+        try:
+            return write_image(self.path, self.canvas, self.quality, self.preset)
+        finally:
+            self.abort()
+    
+    def abort(self):
+        del self.canvas
+        os.unlink(self.raw_path)
+
+@contextmanager
+def open_row_writer(path, width, height, channels=3, quality=None, preset='balanced'):
+    """Row writer for path: streaming PNG for .png, memmap + write_image otherwise (see MemmapRowWriter)
+    
+    The encode stats from closing the writer end up in writer.stats.
+    """
+    if os.path.splitext(path)[1].lower() == '.png':
+        writer = PngRowWriter(path, width, height, channels, preset)
+    else:
+        writer = MemmapRowWriter(path, width, height, channels, quality, preset)
+    try:
+        yield writer
+    except BaseException:
+        writer.abort()
+        raise
+    writer.stats = writer.close()
+
+def upscale_with_espcn(image, scale=2):
+    """Upscaling using ESPCN model"""
+    result = upsample_with_model(f'espcn_{scale}x', image)
+    if result is not None:
+        return result
+    
+    # Fallback to FSRCNN
+    return upscale_lite(image, scale)
+
+# ============== ENGINE SELECTION ==============
+
+# modelType values upscale_image understands; anything else runs the default
+UPSCALE_MODEL_TYPES = ('realesrgan', 'realesrgan-fast', 'realesrgan-anime', 'edsr')
+
+def upscale_model_type(options):
+    """The modelType upscale_image will actually run"""
+    model_type = options.get('modelType', 'realesrgan-fast')
+    return model_type if model_type in UPSCALE_MODEL_TYPES else 'realesrgan-fast'
+
+def hybrid_threshold(options):
+    """Flat-tile threshold for hybrid EDSR tiling (options hybrid, hybridThreshold), or None when it's off"""
+    if not options.get('hybrid'):
+        return None
+    return float(options.get('hybridThreshold', DEFAULT_FLAT_TILE_THRESHOLD))
+
+# Quick engines for the preview of a progressive upscale
+PREVIEW_MODELS = ('lanczos', 'fsrcnn')
+
+# Previews bigger than this are made at a reduced size (same aspect) so they stay quick
+PREVIEW_MAX_PIXELS = 4096 * 4096
+
+def write_preview(image, output_path, scale, options):
+    """Quick upscale for progressive mode, written next to the output; returns its result info
+    
+    options.previewModel is 'lanczos' (default) or 'fsrcnn', options.previewOutput the path
+    (default <output>.preview<ext>). The preview is encoded with the 'fast' preset at the
+    target size, or smaller if that's over PREVIEW_MAX_PIXELS (then always with Lanczos).
+    """
+    model = options.get('previewModel', 'lanczos')
+    if model not in PREVIEW_MODELS:
+        raise ProcessingError(f"Error: Unknown previewModel '{model}' (use {', '.join(PREVIEW_MODELS)})")
+    root, ext = os.path.splitext(output_path)
+    path = options.get('previewOutput') or f"{root}.preview{ext}"
+    
+    h, w = image.shape[:2]
+    factor = min(1.0, (PREVIEW_MAX_PIXELS / (h * w * scale * scale)) ** 0.5)
+    if model == 'fsrcnn' and factor == 1.0:
+        result = upscale_lite(image, scale)
+    else:
+        model = 'lanczos'
+        with timed('resize'):
+            result = cv2.resize(image, (max(1, int(w * scale * factor)), max(1, int(h * scale * factor))),
+                                interpolation=cv2.INTER_LANCZOS4)
+    encoded = write_image(path, result, options.get('quality'), 'fast')
+    metrics = current_metrics()
+    return {
+        "output": path,
+        "width": result.shape[1],
+        "height": result.shape[0],
+        "model": model,
+        "readyMs": round(metrics.elapsed_ms, 1) if metrics is not None else None,
+        "encode": encoded
+    }
+
+# Engines to try for each modelType, best quality first
+FALLBACK_CHAINS = {
+    'realesrgan': ['realesrgan', 'edsr'],              # Best quality (Pro users)
+    'realesrgan-anime': ['realesrgan-anime', 'edsr'],  # Best for anime/art
+    'realesrgan-fast': ['realesrgan-fast', 'lanczos'],  # Good quality, fast (Free users)
+    'edsr': ['edsr'],                                  # Legacy high quality
+}
+
+ENGINE_LABELS = {
+    'realesrgan': 'Real-ESRGAN (Best Quality)',
+    'realesrgan-anime': 'Real-ESRGAN Anime',
+    'realesrgan-fast': 'Real-ESRGAN Fast',
+    'edsr': 'EDSR (Legacy)',
+    'lanczos': 'Lanczos interpolation',
+}
+
+def realesrgan_model(engine, scale):
+    """(Real-ESRGAN model name, scale it runs at) for a realesrgan* engine asked for `scale`x"""
+    if engine == 'realesrgan-fast':
+        return f'realesr-animevideov3-x{scale}', scale
+    # realesrgan-x4plus models only support 4x, so we upscale to 4x and reduce if needed
+    return {'realesrgan': 'realesrgan-x4plus', 'realesrgan-anime': 'realesrgan-x4plus-anime'}[engine], 4
+
+# Rough ms per output megapixel, used until an engine has been measured on this host
+DEFAULT_ENGINE_COST = {
+    'realesrgan': 2000,
+    'realesrgan-anime': 1500,
+    'realesrgan-fast': 500,
+    'edsr': 20000,
+    'lanczos': 20,
+}
+
+class CostModel:
+    """Predicts engine runtime from input pixel count, per engine and scale
+    
+    Each (engine, scale) keeps a least-squares line ms = a + b * megapixels over its
+    measured runs, with older runs decayed so the fit follows the host's current load.
+    Every run is folded into the fits saved in the JSON file, under a file lock, so one-shot
+    CLI processes and pool processes running at the same time all add to the same fits.
+    """
+    
+    DECAY = 0.9
+    
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fits = _read_json(path)  # "engine:scale" -> [n, sum_x, sum_y, sum_xx, sum_xy]
+    
+    def predict(self, engine, scale, pixels):
+        """Expected runtime in ms for an input of `pixels` pixels"""
+        x = pixels / 1e6
+        with self._lock:
+            fit = self._fits.get(f"{engine}:{scale}")
+        if not fit:
+            return DEFAULT_ENGINE_COST[engine] * x * scale * scale
+        n, sx, sy, sxx, sxy = fit
+        spread = n * sxx - sx * sx
+        if spread > 1e-9 * n * n:
+            slope = (n * sxy - sx * sy) / spread
+            if slope > 0:
+                return max(0.0, (sy - slope * sx) / n + slope * x)
+        # One size seen so far (or a noisy fit): assume cost grows in proportion to size
+        return sy / sx * x if sx else sy / n
+    
+    def record(self, engine, scale, pixels, elapsed_ms):
+        """Fold a measured run into the saved fits (picking up other processes' runs) and persist them"""
+        x = pixels / 1e6
+        with self._lock, _file_lock(self.path):
+            fits = {**self._fits, **_read_json(self.path)}
+            n, sx, sy, sxx, sxy = (value * self.DECAY for value in fits.get(f"{engine}:{scale}", [0] * 5))
+            fits[f"{engine}:{scale}"] = [n + 1, sx + x, sy + elapsed_ms, sxx + x * x, sxy + x * elapsed_ms]
+            self._fits = fits
+            try:
+                _write_json_atomic(self.path, fits)
+            except OSError as e:
+                print(f"Warning: Could not save cost model: {str(e)}", file=sys.stderr)
+    
+    def stats(self):
+        with self._lock:
+            return {key: {"runs": round(fit[0], 2), "msPerInputMegapixel": round(fit[2] / fit[1], 1) if fit[1] else None}
+                    for key, fit in self._fits.items()}
+
+COST_MODEL = CostModel(os.environ.get('UPSCALE_COST_MODEL') or
+                       os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cost_model.json'))
+
+def upscale_image(input_path, output_path, options):
+    """Upscale image using selected model type"""
+    scale_str = options.get('model', '2x')
+    scale = int(scale_str.replace('x', ''))
+    tier = options.get('tier', 'free')  # 'free', 'pro', 'business'
+    # Optional parallel tiling for EDSR: tileWorkers > 1 spreads tiles over a 'thread' or 'process' pool,
+    # tileBatch > 1 pushes that many equal-sized tiles through the network per forward pass,
+    # hybrid sends flat tiles (see DEFAULT_FLAT_TILE_THRESHOLD) to Lanczos instead of the network
+    tiling = {
+        'workers': int(options.get('tileWorkers', 1)),
+        'pool': options.get('tilePool', 'thread'),
+        'batch_size': int(options.get('tileBatch', 1)),
+        'flat_threshold': hybrid_threshold(options)
+    }
+    # JPEG/WebP quality (None keeps cv2's defaults) and encoder preset for the output
+    quality = options.get('quality')
+    preset = encode_preset(options)
+    
+    def report_progress(done, total, unit):
+        emit_event('progress', {"progress": {"engine": 'edsr', "done": done, "total": total, "unit": unit,
+                                             "fraction": round(done / total, 4)}})
+    
+    # progress reports each band (or row of tiles) of a tiled EDSR upscale as an interim reply
+    tiling['on_progress'] = report_progress if options.get('progress') else None
+    
+    # Real-ESRGAN reads the file itself, so only decode when a local path needs the pixels
+    image = None
+    def decoded():
+        nonlocal image
+        if image is None:
+            with timed('decode'):
+                image = read_image(input_path)
+            if image is None:
+                raise ProcessingError("Error: Could not read image")
+        return image
+    
+    info = probe_image(input_path)
+    if info:
+        h, w = info["height"], info["width"]
+    else:
+        h, w = decoded().shape[:2]
+    print(f"Input image: {w}x{h}", file=sys.stderr)
+    
+    # Stream EDSR output to disk band by band for very large results (or when asked to);
+    # only PNG output keeps memory to one band throughout (see MemmapRowWriter)
+    streaming = options.get('streaming')
+    if streaming is None:
+        streaming = h * w * scale * scale >= STREAMING_MIN_OUTPUT_PIXELS
+    if isinstance(output_path, OutputBuffer):
+        streaming = False  # The encoded output is held in memory either way
+    
+    def edsr_to_file():
+        """Run tiled EDSR into output_path and return the output shape and encode stats"""
+        if streaming:
+            print("Streaming output in bands", file=sys.stderr)
+            return upscale_with_tiling_to_file(decoded(), output_path, scale, **tiling,
+                                               quality=quality, preset=preset)
+        result = upscale_with_tiling(decoded(), scale, **tiling)
+        return result.shape, write_image(output_path, result, quality, preset)
+    
+    def lanczos_to_file():
+        """Plain Lanczos upscale into output_path and return the output shape and encode stats"""
+        image = decoded()
+        with timed('resize'):
+            result = cv2.resize(image, (w * scale, h * scale), interpolation=cv2.INTER_LANCZOS4)
+        return result.shape, write_image(output_path, result, quality, preset)
+    
+    def realesrgan(engine):
+        model_name, native_scale = realesrgan_model(engine, scale)
+        def run():
+            with scratch_paths(input_path, output_path) as (source_path, target_path):
+                return realesrgan_to_file(source_path, target_path, scale, model_name, native_scale, (w, h),
+                                          quality, preset)
+        return run
+    
+    # Each engine writes output_path and returns (output shape, encode stats), or None if it couldn't run
+    engines = {
+        'realesrgan': realesrgan('realesrgan'),
+        'realesrgan-anime': realesrgan('realesrgan-anime'),
+        'realesrgan-fast': realesrgan('realesrgan-fast'),
+        'edsr': edsr_to_file,
+        'lanczos': lanczos_to_file,
+    }
+    
+    model_type = upscale_model_type(options)
+    chain = FALLBACK_CHAINS[model_type]
+    label = ENGINE_LABELS[model_type] + (" (default)" if options.get('modelType') not in UPSCALE_MODEL_TYPES else "")
+    print(f"Using {label} for {scale}x upscale", file=sys.stderr)
+    
+    # With a deadline, start at the best engine in the chain predicted to make it
+    deadline = options.get('deadlineMs')
+    first = 0
+    if deadline is not None:
+        while first < len(chain) - 1 and COST_MODEL.predict(chain[first], scale, w * h) > float(deadline):
+            first += 1
+        if first:
+            print(f"Skipping {', '.join(chain[:first])} to meet {deadline}ms deadline", file=sys.stderr)
+    
+    # Progressive: put a quick preview out first unless the result itself will be just as quick
+    # (in-memory jobs have no file to put it next to)
+    preview = None
+    if options.get('progressive') and chain[first] != 'lanczos' and not isinstance(output_path, OutputBuffer):
+        preview = write_preview(decoded(), output_path, scale, options)
+        print(f"Preview ready in {preview['readyMs']}ms", file=sys.stderr)
+        emit_event('preview', {"result": preview})
+    
+    for position, model_used in enumerate(chain[first:], first):
+        if position > first:
+            print(f"Falling back to {ENGINE_LABELS[model_used]}...", file=sys.stderr)
+        predicted_ms = COST_MODEL.predict(model_used, scale, w * h)
+        start = time.perf_counter()
+        written = engines[model_used]()
+        actual_ms = (time.perf_counter() - start) * 1000
+        if written is not None:
+            COST_MODEL.record(model_used, scale, w * h, actual_ms)
+            break
+    else:
+        raise ProcessingError("Error: No engine could process the image")
+    
+    # Return info about the result
+    result_shape, encoded = written
+    out_h, out_w = result_shape[:2]
+    result = {
+        "width": out_w, 
+        "height": out_h, 
+        "scale": scale,
+        "model": model_used,
+        "tier": tier,
+        "predictedMs": round(predicted_ms, 1),
+        "actualMs": round(actual_ms, 1),
+        "encode": encoded
+    }
+    if preview is not None:
+        result['preview'] = preview
+    return result
+
+def resize_target(original_w, original_h, options):
+    """Output (width, height) for resize options applied to an original_w x original_h image"""
+    resize_type = options.get('resizeType', 'percentage')
+    maintain_aspect = options.get('maintainAspect', True)
+    
+    if resize_type == 'percentage':
+        percentage = options.get('percentage', 100)
+        new_w = int(original_w * percentage / 100)
+        new_h = int(original_h * percentage / 100)
+    else:  # pixels
+        new_w = options.get('width', original_w)
+        new_h = options.get('height', original_h)
+        
+        if maintain_aspect:
+            # Calculate aspect ratio and adjust
+            aspect = original_w / original_h
+            if new_w / new_h > aspect:
+                new_w = int(new_h * aspect)
+            else:
+                new_h = int(new_w / aspect)
+    
+    # Ensure minimum dimensions
+    return max(1, new_w), max(1, new_h)
+
+# imread flags that let libjpeg scale by 1/2, 1/4 or 1/8 in the DCT domain while decoding
+REDUCED_DECODE_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                        4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+def decode_reduction(info, options):
+    """Largest JPEG decode reduction (1, 2, 4 or 8) that still leaves at least the target size"""
+    if not info or info['format'] != 'jpeg':
+        return 1  # Other decoders would decode in full and then shrink anyway
+    width, height = info['width'], info['height']
+    new_w, new_h = resize_target(width, height, options)
+    for factor in (8, 4, 2):
+        if -(-width // factor) >= new_w and -(-height // factor) >= new_h:
+            return factor
+    return 1
+
+def resize_image(input_path, output_path, options):
+    """Resize image by pixels or percentage
+    
+    Large JPEG reductions decode straight to 1/2, 1/4 or 1/8 size (see decode_reduction)
+    and finish with a precise resize from there.
+    """
+    preset = encode_preset(options)
+    info = probe_image(input_path)
+    factor = decode_reduction(info, options)
+    with timed('decode'):
+        image = read_image(input_path, REDUCED_DECODE_FLAGS[factor])
+    if image is None:
+        raise ProcessingError("Error: Could not read image")
+    
+    original_h, original_w = image.shape[:2]
+    if factor > 1:
+        # Report and size against the full image
+        original_w, original_h = info['width'], info['height']
+        print(f"Decoded at 1/{factor} size for {original_w}x{original_h} input", file=sys.stderr)
+    
+    new_w, new_h = resize_target(original_w, original_h, options)
+    
+    # Choose interpolation method based on scaling direction
+    if new_w < original_w or new_h < original_h:
+        interpolation = cv2.INTER_AREA  # Better for shrinking
+    else:
+        interpolation = cv2.INTER_CUBIC  # Better for enlarging
+    
+    with timed('resize'):
+        result = cv2.resize(image, (new_w, new_h), interpolation=interpolation)
+    
+    encoded = write_image(output_path, result, options.get('quality', 90), preset)
+    
+    return {
+        "width": new_w, 
+        "height": new_h,
+        "originalWidth": original_w,
+        "originalHeight": original_h,
+        "encode": encoded
+    }
+
+# ============== FRAME PIPELINE ==============
+# Video and animated GIF upscaling: frames are decoded one at a time with cv2.VideoCapture,
+# upscaled a batch at a time with the upscale engines and encoded straight into the output
+# (a video, or an animated GIF/WebP). cv2 can't decode animated WebP, so WebP input is refused.
+
+# cv2.VideoWriter codec for each video container
+VIDEO_CODECS = {'.mp4': 'mp4v', '.m4v': 'mp4v', '.mov': 'mp4v', '.mkv': 'mp4v', '.avi': 'MJPG', '.webm': 'VP90'}
+
+# Animated outputs cv2 can't write are piped to the ffmpeg executable (FFMPEG_PATH overrides the PATH lookup)
+FFMPEG_PATH = os.environ.get('FFMPEG_PATH') or shutil.which('ffmpeg')
+FFMPEG_FORMAT_ARGS = {
+    '.gif': ['-filter_complex', 'split[a][b];[a]palettegen[p];[b][p]paletteuse', '-loop', '0'],
+    '.webp': ['-c:v', 'libwebp', '-loop', '0'],
+}
+
+# Frame rate to assume when the container doesn't report one
+DEFAULT_FPS = 25.0
+
+# Largest change in any 8x8 block mean (grayscale, 0-255) for a frame to count as a repeat.
+# Well above codec noise on a static shot, well below a small object moving.
+DEFAULT_DUPLICATE_THRESHOLD = 2.0
+
+# Frames per batch, and a cap on a batch's output pixels so big frames go a few at a time
+DEFAULT_FRAME_BATCH = 4
+FRAME_BATCH_MAX_OUTPUT_PIXELS = 4096 * 4096
+
+def capture_fps(capture):
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    return fps if 0 < fps < 1000 else DEFAULT_FPS
+
+def probe_video(path):
+    """Frame size, rate and count of a video or animated image without decoding any frames
+    
+    Returns {"width", "height", "fps", "frames"} or None if cv2 can't open it. frames is the
+    container's estimate (0 when it doesn't say).
+    """
+    capture = cv2.VideoCapture(path)
+    try:
+        if not capture.isOpened():
+            return None
+        width, height = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if width <= 0 or height <= 0:
+            return None
+        return {"width": width, "height": height, "fps": capture_fps(capture),
+                "frames": max(0, int(capture.get(cv2.CAP_PROP_FRAME_COUNT)))}
+    finally:
+        capture.release()
+
+def read_frames(capture):
+    """Yield (timestamp ms, frame) from an open capture, decoding as they're asked for"""
+    while True:
+        with timed('decode'):
+            ok, frame = capture.read()
+        if not ok:
+            return
+        yield capture.get(cv2.CAP_PROP_POS_MSEC), frame
+
+def frame_signature(frame):
+    """Grayscale 8x8 block means, for spotting repeated frames"""
+    h, w = frame.shape[:2]
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (max(1, w // 8), max(1, h // 8)), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+def realesrgan_frames(frames, scale, model_name, native_scale):
+    """Upscale frames with one directory-mode Real-ESRGAN run; None if it failed"""
+    with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as work_dir:
+        in_dir = os.path.join(work_dir, 'in')
+        out_dir = os.path.join(work_dir, 'out')
+        os.mkdir(in_dir)
+        os.mkdir(out_dir)
+        with timed('encode'):
+            for index, frame in enumerate(frames):
+                cv2.imwrite(os.path.join(in_dir, f"{index}.png"), frame)  # cv2's speed-tuned PNG
+        with timed('inference'):
+            ok = REALESRGAN_BACKEND.run_directory(in_dir, out_dir, native_scale, model_name, len(frames))
+        if not ok:
+            return None
+        results = []
+        for index, frame in enumerate(frames):
+            with timed('decode'):
+                result = cv2.imread(os.path.join(out_dir, f"{index}.png"))
+            if result is None:
+                print("Real-ESRGAN output could not be read", file=sys.stderr)
+                return None
+            h, w = frame.shape[:2]
+            if result.shape[:2] != (h * scale, w * scale):
+                with timed('resize'):
+                    result = cv2.resize(result, (w * scale, h * scale), interpolation=cv2.INTER_AREA)
+            results.append(result)
+        return results
+
+def upscale_frames(engine, frames, scale):
+    """Upscale a batch of same-sized frames with one FALLBACK_CHAINS engine
+    
+    Returns the upscaled frames, or None if the engine couldn't run. Real-ESRGAN takes the
+    batch in one directory-mode invocation; EDSR runs it through one BatchedSuperRes
+    pass, except on frames too big to upscale without tiling.
+    """
+    if engine.startswith('realesrgan'):
+        return realesrgan_frames(frames, scale, *realesrgan_model(engine, scale))
+    h, w = frames[0].shape[:2]
+    if engine == 'lanczos':
+        with timed('resize'):
+            return [cv2.resize(frame, (w * scale, h * scale), interpolation=cv2.INTER_LANCZOS4) for frame in frames]
+    model_key = f'edsr_{scale}x'
+    if get_model_path(model_key)[0] is None:
+        raise ProcessingError(f"Error: EDSR model for {scale}x not found")
+    if h * w > tile_geometry(model_key)[2]:
+        return [upscale_with_tiling(frame, scale) for frame in frames]
+    with MODEL_REGISTRY.acquire(model_key, 'batched', inference_precision(model_key)) as sr:
+        with timed('inference'):
+            return sr.upsample_batch(frames)
+
+class FrameWriter:
+    """Encodes frames into a video with cv2.VideoWriter, or into an animated GIF/WebP through ffmpeg"""
+    
+    @staticmethod
+    def check(path):
+        """Raise ProcessingError if frames can't be written to path's format here"""
+        ext = os.path.splitext(path)[1].lower()
+        if ext in FFMPEG_FORMAT_ARGS:
+            if not FFMPEG_PATH or not os.path.exists(FFMPEG_PATH):
+                raise ProcessingError(f"Error: {ext} output needs ffmpeg (set FFMPEG_PATH)")
+        elif ext not in VIDEO_CODECS:
+            raise ProcessingError(f"Error: Unsupported video output format: {ext or 'none'}")
+    
+    def __init__(self, path, width, height, fps, quality=None):
+        self.check(path)
+        ext = os.path.splitext(path)[1].lower()
+        self.path = path
+        self.format = ext.lstrip('.')
+        self.quality = quality
+        self.writer = None
+        self.process = None
+        self.encode_ms = 0.0
+        if ext in VIDEO_CODECS:
+            self.codec = VIDEO_CODECS[ext]
+            self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*self.codec), fps, (width, height))
+            if not self.writer.isOpened():
+                raise ProcessingError(f"Error: Could not open a {ext} writer")
+            if quality is not None:
+                self.writer.set(cv2.VIDEOWRITER_PROP_QUALITY, quality)  # Only MJPG takes it
+        else:
+            self.codec = 'ffmpeg'
+            cmd = [FFMPEG_PATH, '-v', 'error', '-y', '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+                   '-s', f'{width}x{height}', '-r', f'{fps:g}', '-i', '-', *FFMPEG_FORMAT_ARGS[ext]]
+            if ext == '.webp' and quality is not None:
+                cmd += ['-quality', str(int(quality))]
+            self.process = subprocess.Popen(cmd + [path], stdin=subprocess.PIPE)
+    
+    def write(self, frame):
+        start = time.perf_counter()
+        with timed('encode'):
+            if self.writer is not None:
+                self.writer.write(frame)
+            else:
+                try:
+                    self.process.stdin.write(np.ascontiguousarray(frame).tobytes())
+                except BrokenPipeError:
+                    raise ProcessingError("Error: ffmpeg stopped accepting frames")
+        self.encode_ms += (time.perf_counter() - start) * 1000
+    
+    def close(self):
+        """Finish the file and return encode stats like encode_image's"""
+        start = time.perf_counter()
+        with timed('encode'):
+            if self.writer is not None:
+                self.writer.release()
+            else:
+                self.process.stdin.close()
+                if self.process.wait() != 0:
+                    raise ProcessingError(f"Error: ffmpeg exited with status {self.process.returncode}")
+        self.encode_ms += (time.perf_counter() - start) * 1000
+        return {"format": self.format, "codec": self.codec, "quality": self.quality,
+                "bytes": os.path.getsize(self.path), "encodeMs": round(self.encode_ms, 1)}
+    
+    def abort(self):
+        if self.writer is not None:
+            self.writer.release()
+        else:
+            self.process.kill()
+            self.process.wait()
+
+def upscale_video(input_path, output_path, options):
+    """Upscale every frame of a video or animated GIF into output_path (WebP input isn't supported)
+    
+    Frames are upscaled frameBatch at a time by the first engine in the modelType's chain
+    that works on the first batch, and that engine is kept for the whole clip. A frame
+    within duplicateThreshold of the last frame that went through the engine (see
+    DEFAULT_DUPLICATE_THRESHOLD; 0 means identical frames only) reuses its output instead.
+    The output runs at the source frame rate, and a frame whose timestamp is more than one
+    interval after the previous one (a GIF hold, a variable-rate gap) has the previous
+    output repeated up to it, so timing matches the source. Audio is not carried over.
+    """
+    scale = int(options.get('model', '2x').replace('x', ''))
+    tier = options.get('tier', 'free')
+    quality = options.get('quality')
+    threshold = float(options.get('duplicateThreshold', DEFAULT_DUPLICATE_THRESHOLD))
+    FrameWriter.check(output_path)
+    if (probe_image(input_path) or {}).get('format') == 'webp':
+        # VideoCapture reads no frames from it and would only fail with "Could not read video"
+        raise ProcessingError("Error: WebP input isn't supported in video mode; convert it to GIF or a video first")
+    
+    capture = cv2.VideoCapture(input_path)
+    if not capture.isOpened():
+        raise ProcessingError("Error: Could not read video")
+    fps = capture_fps(capture)
+    w, h = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    batch_size = int(options.get('frameBatch', DEFAULT_FRAME_BATCH))
+    batch_size = max(1, min(batch_size, FRAME_BATCH_MAX_OUTPUT_PIXELS // max(1, w * h * scale * scale)))
+    print(f"Input video: {w}x{h} at {fps:g} fps", file=sys.stderr)
+    
+    model_type = upscale_model_type(options)
+    chain = FALLBACK_CHAINS[model_type]
+    print(f"Using {ENGINE_LABELS[model_type]} for {scale}x upscale, {batch_size} frames per batch", file=sys.stderr)
+    
+    state = {"engine": 0, "writer": None, "written": 0, "last": None}
+    counts = {"frames": 0, "upscaledFrames": 0, "duplicateFrames": 0, "repeatedFrames": 0}
+    batch = []    # Source frames waiting for the engine
+    pending = []  # (output slot, index into batch or None to reuse the last output), in frame order
+    
+    def flush():
+        outputs = []
+        while batch:
+            outputs = upscale_frames(chain[state['engine']], batch, scale)
+            if outputs is not None:
+                break
+            state['engine'] += 1
+            if state['engine'] == len(chain) or state['writer'] is not None:
+                # Switching engines part way through would change the look mid-clip
+                raise ProcessingError("Error: No engine could process the video")
+            print(f"Falling back to {ENGINE_LABELS[chain[state['engine']]]}...", file=sys.stderr)
+        counts['upscaledFrames'] += len(batch)
+        for slot, index in pending:
+            output = state['last'] if index is None else outputs[index]
+            if state['writer'] is None:
+                out_h, out_w = output.shape[:2]
+                state['writer'] = FrameWriter(output_path, out_w, out_h, fps, quality)
+            while state['written'] < slot:
+                state['writer'].write(state['last'])
+                state['written'] += 1
+                counts['repeatedFrames'] += 1
+            state['writer'].write(output)
+            state['written'] += 1
+            state['last'] = output
+        batch.clear()
+        pending.clear()
+    
+    try:
+        key_frame = key_signature = first_ms = None
+        for timestamp_ms, frame in read_frames(capture):
+            if first_ms is None:
+                first_ms = timestamp_ms
+            slot = round((timestamp_ms - first_ms) * fps / 1000)
+            counts['frames'] += 1
+            signature = frame_signature(frame) if threshold > 0 else None
+            if key_frame is not None and (
+                    np.abs(signature - key_signature).max() <= threshold if threshold > 0
+                    else np.array_equal(frame, key_frame)):
+                counts['duplicateFrames'] += 1
+                pending.append((slot, len(batch) - 1 if batch else None))
+                continue
+            key_frame, key_signature = frame, signature
+            batch.append(frame)
+            pending.append((slot, len(batch) - 1))
+            if len(batch) == batch_size:
+                flush()
+        flush()
+        if state['writer'] is None:
+            raise ProcessingError("Error: Could not read video")
+        encoded = state['writer'].close()
+    except BaseException:
+        if state['writer'] is not None:
+            state['writer'].abort()
+        raise
+    finally:
+        capture.release()
+    
+    out_h, out_w = state['last'].shape[:2]
+    return {
+        "width": out_w,
+        "height": out_h,
+        "scale": scale,
+        "model": chain[state['engine']],
+        "tier": tier,
+        "fps": round(fps, 3),
+        **counts,
+        "durationMs": round(state['written'] * 1000 / fps, 1),
+        "encode": encoded
+    }
+
+# ============== IN-MEMORY JOBS ==============
+# Upscale and resize jobs can take the encoded input as bytes and leave the encoded output
+# in an OutputBuffer, so a request never touches the disk (--stdio, and inputBytes/outputFormat
+# jobs in the worker). Only Real-ESRGAN, which reads and writes files itself, goes through SCRATCH_DIR.
+
+class OutputBuffer:
+    """Stands in for an output path: the encoded result lands in .data"""
+    
+    def __init__(self, image_format):
+        self.ext = '.' + str(image_format).lower().lstrip('.')
+        if self.ext not in ENCODE_FORMATS:
+            raise ProcessingError(f"Error: Unsupported output format: {image_format}")
+        self.data = None
+
+def read_image(source, flags=cv2.IMREAD_COLOR):
+    """cv2.imread for a path, cv2.imdecode for encoded image bytes"""
+    if isinstance(source, bytes):
+        return cv2.imdecode(np.frombuffer(source, dtype=np.uint8), flags)
+    return cv2.imread(source, flags)
+
+@contextmanager
+def scratch_paths(input_path, output_path):
+    """Real file paths for a job's input and output, for tools that only take paths
+    
+    Input bytes are written to SCRATCH_DIR, and an OutputBuffer is filled from its scratch
+    file when the block exits cleanly. Plain paths pass straight through.
+    """
+    created = []
+    
+    def scratch(ext, data=b''):
+        fd, path = tempfile.mkstemp(suffix=ext, dir=SCRATCH_DIR)
+        created.append(path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return path
+    
+    try:
+        source_path, target_path = input_path, output_path
+        if isinstance(input_path, bytes):
+            info = probe_image(input_path)
+            source_path = scratch('.' + (info['format'] if info else 'img'), input_path)
+        if isinstance(output_path, OutputBuffer):
+            target_path = scratch(output_path.ext)
+        yield source_path, target_path
+        if isinstance(output_path, OutputBuffer) and os.path.getsize(target_path):
+            with open(target_path, 'rb') as f:
+                output_path.data = f.read()
+    finally:
+        for path in created:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+def run_stdio(args):
+    """Entry point for `upscale_script.py --stdio <upscale|resize> <format> [options_json]`
+    
+    Reads the encoded input image from stdin. On success stdout gets one result JSON line
+    with "outputBytes": N, followed by exactly N bytes of the encoded output.
+    """
+    if len(args) < 2:
+        print("Usage: upscale_script.py --stdio <upscale|resize> <format> [options_json]", file=sys.stderr)
+        return 1
+    mode, image_format = args[0], args[1]
+    try:
+        options = json.loads(args[2]) if len(args) > 2 else {}
+        data = sys.stdin.buffer.read()
+        if not data:
+            raise ProcessingError("Error: No input on stdin")
+        output = OutputBuffer(image_format)
+        result = run_job(data, output, mode, options)
+    except Exception as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    result = {**with_peak_rss(result), "outputBytes": len(output.data)}
+    sys.stdout.buffer.write((json.dumps(result) + '\n').encode('utf-8'))
+    sys.stdout.buffer.write(output.data)
+    sys.stdout.buffer.flush()
+    print("Done", file=sys.stderr)
+    return 0
+
+# ============== RESULT CACHE ==============
+# Finished outputs keyed by a hash of the input bytes plus the options that change them.
+
+# Options that affect the output, with the defaults upscale_image/resize_image apply
+CACHE_KEY_OPTIONS = {
+    'upscale': {'model': '2x', 'modelType': 'realesrgan-fast', 'quality': None, 'encodePreset': 'balanced',
+                'hybrid': False, 'hybridThreshold': DEFAULT_FLAT_TILE_THRESHOLD},
+    'resize': {'resizeType': 'percentage', 'percentage': 100, 'width': None, 'height': None,
+               'maintainAspect': True, 'quality': 90, 'encodePreset': 'balanced'},
+}
+
+def cache_key(input_path, output_path, mode, options):
+    """Hash of the input file, the normalized options and the output extension"""
+    params = {name: options.get(name, default) for name, default in CACHE_KEY_OPTIONS.get(mode, {}).items()}
+    if mode == 'upscale':
+        params['modelType'] = upscale_model_type(options)
+        if not params['modelType'].startswith('realesrgan'):
+            params['inferencePrecision'] = inference_settings(options)[0]
+        params['hybrid'] = bool(params['hybrid'])
+        if not params['hybrid']:
+            del params['hybridThreshold']
+    if mode == 'resize':
+        # Only one of the sizing modes is looked at
+        if params['resizeType'] == 'percentage':
+            del params['width'], params['height'], params['maintainAspect']
+        else:
+            del params['percentage']
+    # 50 and 50.0 give the same image
+    params = {name: float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+              for name, value in params.items()}
+    
+    digest = hashlib.sha256()
+    with open(input_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    ext = os.path.splitext(output_path)[1].lower()
+    digest.update(json.dumps([mode, params, ext], sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+class ResultCache:
+    """Size-bounded LRU store of encoded outputs on local disk
+    
+    Each entry is <key><ext> with the job's result JSON next to it in <key>.json; the JSON
+    is written last, so an entry only counts once both files are complete. Recency is kept
+    in file mtimes, which lets a restarted process (or the one-shot CLI) pick up the order.
+    """
+    
+    def __init__(self, directory, max_size_mb=2048):
+        self.directory = directory
+        self.max_bytes = max_size_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (ext, bytes), least recently used first
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+    
+    def _paths(self, key, ext):
+        base = os.path.join(self.directory, key)
+        return base + ext, base + '.json'
+    
+    def _scan(self):
+        """Rebuild the index from whatever complete entries are on disk"""
+        found = []
+        for name in os.listdir(self.directory):
+            key, ext = os.path.splitext(name)
+            if ext == '.json' or ext == '.tmp' or not os.path.exists(os.path.join(self.directory, key + '.json')):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            found.append((stat.st_mtime, key, ext, stat.st_size))
+        for _, key, ext, size in sorted(found):
+            self._entries[key] = (ext, size)
+            self._bytes += size
+        with self._lock:
+            self._evict()
+    
+    def _remove(self, key, ext):
+        for path in self._paths(key, ext):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+    
+    def _evict(self):
+        """Drop least recently used entries until we're back under budget (caller holds the lock)"""
+        while self._bytes > self.max_bytes and self._entries:
+            key, (ext, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self._stats['evictions'] += 1
+            self._remove(key, ext)
+    
+    def lookup(self, key, output_path):
+        """Copy a cached output to output_path and return its result JSON, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None:
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+        data_path, meta_path = self._paths(key, entry[0])
+        try:
+            with open(meta_path) as f:
+                result = json.load(f)
+            shutil.copyfile(data_path, output_path)
+            os.utime(data_path)
+        except (OSError, ValueError):
+            # Evicted by another process (or damaged); forget it and recompute
+            with self._lock:
+                if self._entries.pop(key, None) is not None:
+                    self._bytes -= entry[1]
+                self._stats['misses'] += 1
+            return None
+        with self._lock:
+            self._stats['hits'] += 1
+        return result
+    
+    def store(self, key, output_path, result):
+        """Add a finished output to the cache"""
+        ext = os.path.splitext(output_path)[1].lower()
+        data_path, meta_path = self._paths(key, ext)
+        try:
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            os.close(fd)
+            shutil.copyfile(output_path, tmp_path)
+            os.replace(tmp_path, data_path)
+            _write_json_atomic(meta_path, result)
+            size = os.path.getsize(data_path)
+        except OSError as e:
+            print(f"Warning: Could not cache result: {str(e)}", file=sys.stderr)
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (ext, size)
+            self._bytes += size
+            self._stats['stores'] += 1
+            self._evict()
+    
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                "hitRatio": round(self._stats['hits'] / lookups, 4) if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "maxBytes": self.max_bytes
+            }
+
+# Off unless UPSCALE_CACHE_DIR is set (or the worker is started with --cache-dir)
+RESULT_CACHE = (ResultCache(os.environ['UPSCALE_CACHE_DIR'], int(os.environ.get('UPSCALE_CACHE_MB', 2048)))
+                if os.environ.get('UPSCALE_CACHE_DIR') else None)
+
+def resize_variants(input_path, output_dir, options):
+    """Produce several resized variants of one image from a single decode
+    
+    options['variants'] is a list of resize option dicts, each with an 'output' file name
+    (relative names go in output_dir); keys set on the job itself (e.g. quality) apply to
+    every variant that doesn't override them. Variants are made largest first from a
+    pyramid of 2x INTER_AREA reductions that's shared between them, each finished with one
+    precise resize from the smallest level still at least its size, and encoded in parallel.
+    """
+    specs = options.get('variants')
+    if not specs or not isinstance(specs, list):
+        raise ProcessingError("Error: resize-batch needs a non-empty 'variants' list")
+    shared = {key: value for key, value in options.items() if key != 'variants'}
+    variants = []
+    for spec in specs:
+        if 'output' not in spec:
+            raise ProcessingError("Error: Every variant needs an 'output'")
+        variant = {**shared, **spec}
+        variant['encodePreset'] = encode_preset(variant)
+        variants.append(variant)
+    
+    # Decode once, as small as the largest variant allows
+    info = probe_image(input_path)
+    factor = min(decode_reduction(info, variant) for variant in variants)
+    with timed('decode'):
+        image = cv2.imread(input_path, REDUCED_DECODE_FLAGS[factor])
+    if image is None:
+        raise ProcessingError("Error: Could not read image")
+    original_h, original_w = image.shape[:2]
+    if factor > 1:
+        original_w, original_h = info['width'], info['height']
+    
+    targets = [resize_target(original_w, original_h, variant) for variant in variants]
+    pyramid = [image]
+    results = [None] * len(variants)
+    for index in sorted(range(len(variants)), key=lambda i: targets[i][0] * targets[i][1], reverse=True):
+        new_w, new_h = targets[index]
+        if new_w < original_w or new_h < original_h:
+            # Halve while the next level would still cover this variant
+            with timed('resize'):
+                while True:
+                    level_h, level_w = pyramid[-1].shape[:2]
+                    half_w, half_h = -(-level_w // 2), -(-level_h // 2)
+                    if half_w < new_w or half_h < new_h or level_w < 2 or level_h < 2:
+                        break
+                    pyramid.append(cv2.resize(pyramid[-1], (half_w, half_h), interpolation=cv2.INTER_AREA))
+                source = next(level for level in reversed(pyramid)
+                              if level.shape[1] >= new_w and level.shape[0] >= new_h)
+                results[index] = cv2.resize(source, (new_w, new_h), interpolation=cv2.INTER_AREA)
+        else:
+            with timed('resize'):
+                results[index] = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_CUBIC)
+    del pyramid
+    
+    def encode(variant, result):
+        output_path = os.path.join(output_dir, variant['output'])
+        return output_path, write_image(output_path, result, variant.get('quality', 90), variant['encodePreset'])
+    
+    # cv2 encoders release the GIL, so variants encode side by side
+    with ThreadPoolExecutor(max_workers=max(1, min(len(variants), os.cpu_count() or 1))) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, encode, variant, result)
+                   for variant, result in zip(variants, results)]
+        outputs = [future.result() for future in futures]
+    
+    return {
+        "originalWidth": original_w,
+        "originalHeight": original_h,
+        "variants": [{"output": output_path, "width": new_w, "height": new_h, "encode": encoded}
+                     for (output_path, encoded), (new_w, new_h) in zip(outputs, targets)]
+    }
+
+def run_job(input_path, output_path, mode, options, metrics=None, on_event=None):
+    """Run a single upscale/resize job and return its result info, including stage timings
+    
+    Pass a JobMetrics to keep hold of the raw measurements (the worker feeds them to its histograms).
+    Upscale and resize also take the input as encoded bytes and an OutputBuffer as the output.
+    on_event(status, payload) gets the job's interim replies (a progressive upscale's
+    preview and progress) as they happen. The MODELS networks run at the job's
+    inference_settings. inferenceThreads goes through cv_threads: OpenCV's thread count is
+    process-wide, so jobs overlapping in a worker run on the latest one asked for, and the
+    worker's own count comes back once none of them is running.
+    """
+    metrics = metrics or JobMetrics()
+    precision, threads = inference_settings(options)
+    token = _job_metrics.set(metrics)
+    events_token = _job_events.set(on_event)
+    precision_token = _inference_precision.set(precision)
+    try:
+        with cv_threads(threads) if threads else nullcontext():
+            result = _run_job(input_path, output_path, mode, options)
+    finally:
+        _inference_precision.reset(precision_token)
+        _job_events.reset(events_token)
+        _job_metrics.reset(token)
+    return {**result, **metrics.report()}
+
+def _run_job(input_path, output_path, mode, options):
+    if not isinstance(input_path, (str, bytes, os.PathLike)):
+        raise ProcessingError("Error: input must be a file path or image bytes")
+    in_memory = isinstance(input_path, bytes) or isinstance(output_path, OutputBuffer)
+    if in_memory and mode not in ('upscale', 'resize'):
+        raise ProcessingError(f"Error: Mode {mode} needs file paths")
+    if mode == 'resize-batch':
+        # output_path is the directory for the variants; not cached
+        return resize_variants(input_path, output_path, options)
+    if mode == 'video':
+        # Frames are encoded straight into output_path; not cached
+        return upscale_video(input_path, output_path, options)
+    if mode not in ('upscale', 'resize'):
+        raise ProcessingError(f"Unknown mode: {mode}")
+    
+    key = None
+    if RESULT_CACHE is not None and not in_memory and os.path.isfile(input_path):
+        key = cache_key(input_path, output_path, mode, options)
+        cached = RESULT_CACHE.lookup(key, output_path)
+        if cached is not None:
+            print("Served from result cache", file=sys.stderr)
+            if 'tier' in cached:
+                cached['tier'] = options.get('tier', 'free')
+            return {**cached, "cached": True}
+    
+    if mode == 'upscale':
+        result = upscale_image(input_path, output_path, options)
+    else:
+        result = resize_image(input_path, output_path, options)
+    
+    # Don't pin a fallback (e.g. Lanczos while Real-ESRGAN was unavailable) in the cache
+    fell_back = mode == 'upscale' and result['model'] != upscale_model_type(options)
+    if key is not None and not fell_back:
+        RESULT_CACHE.store(key, output_path, result)
+    return result
+
+# ============== WORKER MODE ==============
+# Long-lived process that keeps models loaded between jobs.
+# Jobs are JSON lines: {"id": ..., "input": ..., "output": ..., "mode": ..., "options": {...}}
+# Replies are JSON lines: {"id": ..., "status": "ok", "result": {...}}
+#                      or {"id": ..., "status": "error", "error": "..."}
+#                      or {"id": ..., "status": "rejected", "error": "...", "retryAfterMs": ...}
+# A progressive upscale (options.progressive) first replies {"id": ..., "status": "preview", "result": {...}}
+# and, with options.progress, {"id": ..., "status": "progress", "progress": {...}} as bands finish,
+# before its final reply.
+# Jobs are queued by options.tier and only rejected (by admission control, see JobScheduler)
+# when the worker predicts it can't start or finish them in time.
+# Mode "resize-batch" takes options.variants (a list of resize options, each with an "output"
+# file name relative to the job's output directory) and returns one entry per variant.
+# Mode "video" upscales a video or animated GIF frame by frame (see upscale_video).
+# Upscale and resize jobs can skip the disk: a job line with "inputBytes": N is followed by N
+# bytes of encoded image (instead of "input"), and with "outputFormat" (jpg, png, webp) instead
+# of "output" its ok reply carries "outputBytes": M and is followed by M bytes of encoded output.
+# A {"id": ..., "mode": "probe", "paths": [...]} job replies with probe_images() for the paths.
+# A {"id": ..., "mode": "stats"} job replies with the worker's counters.
+# With --metrics-port, stage timing histograms are also served at /metrics.
+
+class StageHistograms:
+    """Prometheus-style histograms of job stage and tile times, served by --metrics-port"""
+    
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}  # (metric, labels) -> [per-bucket counts..., sum, count]
+        self._jobs = {}  # (mode, status) -> count
+    
+    def _observe(self, metric, labels, seconds):
+        series = self._series.setdefault((metric, labels), [0] * len(self.BUCKETS) + [0.0, 0])
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                series[i] += 1
+        series[-2] += seconds
+        series[-1] += 1
+    
+    def observe_wait(self, tier, seconds):
+        with self._lock:
+            self._observe('upscale_queue_wait_seconds', (('tier', tier),), seconds)
+    
+    def observe_job(self, mode, status, metrics=None, model=''):
+        with self._lock:
+            self._jobs[(mode, status)] = self._jobs.get((mode, status), 0) + 1
+            if metrics is None:
+                return
+            labels = (('mode', mode), ('model', model))
+            self._observe('upscale_job_duration_seconds', labels, metrics.elapsed_ms / 1000)
+            for stage in metrics.timed_stages:
+                self._observe('upscale_stage_duration_seconds', labels + (('stage', stage),), metrics.stages[stage] / 1000)
+            for tile_ms in metrics.tile_ms:
+                self._observe('upscale_tile_inference_seconds', (('model', model),), tile_ms / 1000)
+    
+    def render(self):
+        """Text exposition format"""
+        lines = []
+        with self._lock:
+            for metric, help_text in (('upscale_job_duration_seconds', 'Wall-clock time per job'),
+                                      ('upscale_stage_duration_seconds', 'Time per job stage'),
+                                      ('upscale_tile_inference_seconds', 'Inference time per tile'),
+                                      ('upscale_queue_wait_seconds', 'Time jobs spent queued, by tier')):
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+                for (name, labels), series in sorted(self._series.items()):
+                    if name != metric:
+                        continue
+                    label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                    for bound, count in zip(self.BUCKETS, series):
+                        lines.append(f'{metric}_bucket{{{label_text},le="{bound}"}} {count}')
+                    lines.append(f'{metric}_bucket{{{label_text},le="+Inf"}} {series[-1]}')
+                    lines.append(f"{metric}_sum{{{label_text}}} {series[-2]:.6f}")
+                    lines.append(f"{metric}_count{{{label_text}}} {series[-1]}")
+            lines += ["# HELP upscale_jobs_total Jobs handled", "# TYPE upscale_jobs_total counter"]
+            lines += [f'upscale_jobs_total{{mode="{mode}",status="{status}"}} {count}'
+                      for (mode, status), count in sorted(self._jobs.items())]
+        if JOB_SCHEDULER is not None:
+            lines += ["# HELP upscale_queue_depth Jobs waiting to start", "# TYPE upscale_queue_depth gauge"]
+            lines += [f'upscale_queue_depth{{tier="{tier}"}} {depth}'
+                      for tier, depth in JOB_SCHEDULER.queue_depths().items()]
+        peak = peak_rss_mb()
+        if peak is not None:
+            lines += ["# HELP upscale_peak_rss_bytes Peak resident memory of the worker",
+                      "# TYPE upscale_peak_rss_bytes gauge", f"upscale_peak_rss_bytes {int(peak * 1024 * 1024)}"]
+        return "\n".join(lines) + "\n"
+
+# Set by the worker when --metrics-port is given
+STAGE_HISTOGRAMS = None
+
+def serve_metrics(port):
+    """Serve STAGE_HISTOGRAMS at http://0.0.0.0:port/metrics from a background thread"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = STAGE_HISTOGRAMS.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, *args):
+            pass  # Scrapes would drown out job logs
+    
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics on http://0.0.0.0:{port}/metrics", file=sys.stderr)
+    return server
+
+# Scheduling: jobs wait in one queue per tier and start when a thread is free and their
+# compute units (output megapixels x MODEL_WEIGHTS) fit under the worker's cap.
+TIERS = ('business', 'pro', 'free')
+# A job counts as having arrived this much earlier for its tier, so higher tiers go first
+# without starving lower ones (a free job that has waited long enough still gets its turn)
+TIER_HEAD_START_S = {'business': 120, 'pro': 30, 'free': 0}
+# Longest predicted queue wait a job without a deadlineMs is accepted with (None = no limit)
+TIER_MAX_WAIT_S = {'business': None, 'pro': 300, 'free': 60}
+
+# Most of the worker's compute units one job can hold, so a huge job (say 4x EDSR on a
+# large photo) still leaves room for small jobs to run beside it
+MAX_JOB_SHARE = 0.75
+
+# Relative compute per output megapixel (Lanczos = 1)
+MODEL_WEIGHTS = {engine: cost / DEFAULT_ENGINE_COST['lanczos'] for engine, cost in DEFAULT_ENGINE_COST.items()}
+
+def job_cost(job):
+    """(compute units, predicted ms, predicted ms on the fastest fallback) for a worker job
+    
+    Jobs whose cost can't be worked out (unreadable input, bad options) count as one unit
+    and no time; they fail as soon as they run.
+    """
+    options = job.get('options') or {}
+    mode = job.get('mode', 'upscale')
+    source = job.get('input')
+    info = None
+    if mode == 'video' and isinstance(source, str):
+        info = probe_video(source)
+    elif mode != 'video' and isinstance(source, (str, bytes)):
+        info = probe_image(source)  # In-memory jobs carry the encoded bytes
+    if not info:
+        return 1.0, 0.0, 0.0
+    w, h = info['width'], info['height']
+    try:
+        if mode in ('upscale', 'video'):
+            # A video holds one frame's worth of units at a time but takes every frame's time
+            scale = int(str(options.get('model', '2x')).replace('x', ''))
+            chain = FALLBACK_CHAINS[upscale_model_type(options)]
+            frames = max(1, info.get('frames', 1))
+            units = w * h * scale * scale / 1e6 * MODEL_WEIGHTS[chain[0]]
+            return (units, frames * COST_MODEL.predict(chain[0], scale, w * h),
+                    frames * COST_MODEL.predict(chain[-1], scale, w * h))
+        variants = (options.get('variants') or []) if mode == 'resize-batch' else [options]
+        megapixels = (w * h + sum(new_w * new_h for new_w, new_h in (resize_target(w, h, v) for v in variants))) / 1e6
+    except (ValueError, TypeError, AttributeError, ZeroDivisionError):
+        return 1.0, 0.0, 0.0
+    predicted_ms = megapixels * DEFAULT_ENGINE_COST['lanczos']
+    return megapixels * MODEL_WEIGHTS['lanczos'], predicted_ms, predicted_ms
+
+class JobScheduler:
+    """Tier-priority queues in front of the worker's thread pool, with admission control
+    
+    A job starts once a thread is free and the compute units in flight plus its own stay
+    within max_units (each job is charged at most MAX_JOB_SHARE of them). The queue is strictly
+    in order of head-started arrival time, so a big job at the front holds back smaller
+    ones behind it rather than starving. On submit the job's queue wait is predicted from
+    COST_MODEL times of everything ahead of it; jobs that couldn't meet their deadlineMs
+    (even on their chain's fastest engine) or their tier's TIER_MAX_WAIT_S are answered
+    straight away with status "rejected" and a retryAfterMs.
+    """
+    
+    def __init__(self, executor, concurrency, max_units=2000):
+        self.executor = executor
+        self.concurrency = concurrency
+        self.max_units = max_units
+        self._lock = threading.Lock()
+        self._queues = {tier: deque() for tier in TIERS}
+        self._running = 0
+        self._running_units = 0.0
+        self._running_ms = 0.0
+        self._waits = {tier: deque(maxlen=1000) for tier in TIERS}  # Recent queue waits, ms
+        self._stats = {"admitted": 0, "rejected": 0, "completed": 0}
+    
+    def submit(self, job, write_reply):
+        """Queue a job (or reject it); returns a Future that's done once its reply is written"""
+        done = Future()
+        error = self._invalid(job)
+        if error is not None:
+            # Answered like a failed job; nothing about it can be trusted enough to queue it
+            write_reply({"id": job.get('id'), "status": "error", "error": error})
+            if STAGE_HISTOGRAMS is not None:
+                STAGE_HISTOGRAMS.observe_job(str(job.get('mode', 'upscale')), 'error')
+            done.set_result(None)
+            return done
+        options = job.get('options') or {}
+        tier = options.get('tier') if options.get('tier') in TIERS else 'free'
+        units, predicted_ms, fastest_ms = job_cost(job)
+        now = time.monotonic()
+        entry = {"job": job, "tier": tier, "units": min(units, self.max_units * MAX_JOB_SHARE), "predictedMs": predicted_ms,
+                 "arrival": now - TIER_HEAD_START_S[tier], "enqueued": now, "reply": write_reply, "done": done}
+        
+        with self._lock:
+            wait_ms = self._predicted_wait_ms(entry['arrival'])
+            deadline = options.get('deadlineMs')
+            max_wait = TIER_MAX_WAIT_S[tier]
+            rejection = None
+            if deadline is not None and wait_ms + fastest_ms > float(deadline):
+                rejection = (f"Error: Can't finish within {deadline}ms (about {wait_ms:.0f}ms queued "
+                             f"+ {fastest_ms:.0f}ms to run)", wait_ms + fastest_ms - float(deadline))
+            elif deadline is None and max_wait is not None and wait_ms > max_wait * 1000:
+                rejection = (f"Error: Worker busy (predicted wait {wait_ms / 1000:.0f}s)", wait_ms - max_wait * 1000)
+            if rejection is None:
+                self._stats['admitted'] += 1
+                self._queues[tier].append(entry)
+                self._dispatch()
+            else:
+                self._stats['rejected'] += 1
+        
+        if rejection is not None:
+            error, retry_after_ms = rejection
+            print(f"Job {job.get('id')} rejected: {error}", file=sys.stderr)
+            write_reply({"id": job.get('id'), "status": "rejected", "error": error,
+                         "retryAfterMs": int(retry_after_ms) + 1})
+            if STAGE_HISTOGRAMS is not None:
+                STAGE_HISTOGRAMS.observe_job(str(job.get('mode', 'upscale')), 'rejected')
+            done.set_result(None)
+        return done
+    
+    @staticmethod
+    def _invalid(job):
+        """Why the scheduler can't queue job (its options or deadlineMs are malformed), or None"""
+        options = job.get('options') or {}
+        if not isinstance(options, dict):
+            return "Error: options must be a JSON object"
+        deadline = options.get('deadlineMs')
+        if deadline is not None:
+            try:
+                float(deadline)
+            except (TypeError, ValueError):
+                return f"Error: deadlineMs must be a number, got {deadline!r}"
+        return None
+    
+    def _predicted_wait_ms(self, arrival):
+        """Queue wait for a job with this (head-started) arrival time, from predicted run times"""
+        ahead_ms = sum(entry['predictedMs'] for queue in self._queues.values() for entry in queue
+                       if entry['arrival'] <= arrival)
+        if not ahead_ms and self._running < self.concurrency:
+            return 0.0
+        return (ahead_ms + self._running_ms) / self.concurrency
+    
+    def _dispatch(self):
+        """Start queued jobs while there's room (called with the lock held)"""
+        while self._running < self.concurrency:
+            heads = [queue[0] for queue in self._queues.values() if queue]
+            if not heads:
+                return
+            entry = min(heads, key=lambda head: head['arrival'])
+            if self._running and self._running_units + entry['units'] > self.max_units:
+                return
+            self._queues[entry['tier']].popleft()
+            self._running += 1
+            self._running_units += entry['units']
+            self._running_ms += entry['predictedMs']
+            self.executor.submit(self._run, entry)
+    
+    def _run(self, entry):
+        wait_ms = (time.monotonic() - entry['enqueued']) * 1000
+        job = entry['job']
+        options = job.get('options') or {}
+        if options.get('deadlineMs') is not None:
+            # The engine choice only gets what's left of the deadline after queueing
+            job = {**job, "options": {**options, "deadlineMs": max(0.0, float(options['deadlineMs']) - wait_ms)}}
+        try:
+            reply = handle_job(job, entry['reply'])
+            if reply.get('status') == 'ok' and isinstance(reply.get('result'), dict):
+                reply['result']['queueWaitMs'] = round(wait_ms, 1)
+            entry['reply'](reply)
+        finally:
+            with self._lock:
+                self._waits[entry['tier']].append(wait_ms)
+                self._stats['completed'] += 1
+                self._running -= 1
+                self._running_units -= entry['units']
+                self._running_ms -= entry['predictedMs']
+                self._dispatch()
+            if STAGE_HISTOGRAMS is not None:
+                STAGE_HISTOGRAMS.observe_wait(entry['tier'], wait_ms / 1000)
+            entry['done'].set_result(None)
+    
+    def queue_depths(self):
+        with self._lock:
+            return {tier: len(queue) for tier, queue in self._queues.items()}
+    
+    def stats(self):
+        with self._lock:
+            waits = {}
+            for tier, recent in self._waits.items():
+                ordered = sorted(recent)
+                if ordered:
+                    waits[tier] = {"mean": round(sum(ordered) / len(ordered), 1),
+                                   "p50": round(ordered[len(ordered) // 2], 1),
+                                   "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 1),
+                                   "max": round(ordered[-1], 1)}
+            return {**self._stats,
+                    "queued": {tier: len(queue) for tier, queue in self._queues.items()},
+                    "running": self._running,
+                    "unitsInFlight": round(self._running_units, 1),
+                    "maxUnits": self.max_units,
+                    "predictedWaitMs": {tier: round(self._predicted_wait_ms(time.monotonic() - TIER_HEAD_START_S[tier]), 1)
+                                        for tier in TIERS},
+                    "waitMs": waits}
+
+# Set by the worker
+JOB_SCHEDULER = None
+
+def worker_stats():
+    """Counters reported for a {"mode": "stats"} job"""
+    # Peak memory is the worker's over its lifetime; jobs share the process, so it isn't per job
+    stats = {"process": {"peakRssMb": peak_rss_mb()}, "models": MODEL_REGISTRY.stats()}
+    if RESULT_CACHE is not None:
+        stats['cache'] = RESULT_CACHE.stats()
+    stats['realesrgan'] = REALESRGAN_BACKEND.stats()
+    stats['costModel'] = COST_MODEL.stats()
+    stats['tileProfiles'] = TILE_PROFILES.stats()
+    stats['inferenceProfiles'] = INFERENCE_PROFILES.stats()
+    if INFERENCE_BATCHER is not None:
+        stats['batching'] = INFERENCE_BATCHER.stats()
+    if JOB_SCHEDULER is not None:
+        stats['scheduler'] = JOB_SCHEDULER.stats()
+    if TILE_CACHE is not None:
+        stats['tileCache'] = TILE_CACHE.stats()
+    return stats
+
+def handle_job(job, write_reply=None):
+    """Run one worker job and build its reply (never raises)
+    
+    Interim replies (preview, progress) go straight to write_reply when it's given.
+    """
+    job_id = job.get('id')
+    mode = job.get('mode', 'upscale')
+    metrics = JobMetrics()
+    on_event = None
+    if write_reply is not None:
+        on_event = lambda status, payload: write_reply({"id": job_id, "status": status, **payload})
+    try:
+        if mode == 'stats':
+            return {"id": job_id, "status": "ok", "result": worker_stats()}
+        if mode == 'probe':
+            paths = job.get('paths') or ([job['input']] if 'input' in job else [])
+            if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+                return {"id": job_id, "status": "error", "error": "Error: paths must be a list of file paths"}
+            return {"id": job_id, "status": "ok", "result": probe_images(paths)}
+        output = OutputBuffer(job['outputFormat']) if 'outputFormat' in job else job['output']
+        result = run_job(job['input'], output, mode, job.get('options') or {}, metrics, on_event)
+        if STAGE_HISTOGRAMS is not None:
+            STAGE_HISTOGRAMS.observe_job(mode, 'ok', metrics, result.get('model', ''))
+        reply = {"id": job_id, "status": "ok", "result": result}
+        if isinstance(output, OutputBuffer):
+            reply['payload'] = output.data  # Sent after the JSON line by frame_reply
+        return reply
+    except KeyError as e:
+        reply = {"id": job_id, "status": "error", "error": f"Missing field: {e.args[0]}"}
+    except Exception as e:
+        print(f"Job {job_id} failed: {str(e)}", file=sys.stderr)
+        reply = {"id": job_id, "status": "error", "error": str(e)}
+    if STAGE_HISTOGRAMS is not None:
+        STAGE_HISTOGRAMS.observe_job(str(mode), 'error')
+    return reply
+
+def frame_reply(reply):
+    """Wire bytes for a reply: its JSON line, followed by the encoded output of an in-memory job"""
+    payload = reply.pop('payload', None)
+    if payload is None:
+        return (json.dumps(reply) + '\n').encode('utf-8')
+    return (json.dumps({**reply, "outputBytes": len(payload)}) + '\n').encode('utf-8') + payload
+
+def serve_lines(stream, write_reply, scheduler):
+    """Submit every JSON line read from the binary `stream` to the scheduler, replying as each job finishes
+    
+    Replies are written in completion order, so clients must match them up by id.
+    Stats and probe jobs are answered straight away instead of queueing behind image work.
+    A job with "inputBytes" takes that many bytes following its line as the input.
+    Returns the futures so callers can wait for outstanding jobs.
+    """
+    futures = []
+    for raw in iter(stream.readline, b''):
+        line = raw.decode('utf-8', errors='replace').strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            write_reply({"id": None, "status": "error", "error": f"Invalid JSON: {str(e)}"})
+            continue
+        if not isinstance(job, dict):
+            write_reply({"id": None, "status": "error", "error": "Job must be a JSON object"})
+            continue
+        if 'inputBytes' in job:
+            size = job['inputBytes']
+            data = stream.read(size) if isinstance(size, int) and size > 0 else b''
+            if len(data) != size:
+                # The stream can't be resynchronised after a bad length, so stop reading
+                write_reply({"id": job.get('id'), "status": "error", "error": "Error: Input shorter than inputBytes"})
+                break
+            job['input'] = data
+        if job.get('mode') in ('stats', 'probe'):
+            write_reply(handle_job(job))
+            continue
+        futures.append(scheduler.submit(job, write_reply))
+    return futures
+
+def serve_stdin(scheduler):
+    """Read jobs from stdin and write replies to stdout until EOF"""
+    lock = threading.Lock()
+    
+    def write_reply(reply):
+        with lock:
+            sys.stdout.buffer.write(frame_reply(reply))
+            sys.stdout.buffer.flush()
+    
+    futures = serve_lines(sys.stdin.buffer, write_reply, scheduler)
+    for future in futures:
+        future.result()
+
+def serve_socket(socket_path, scheduler):
+    """Accept connections on a Unix socket; each connection speaks the same JSON-lines protocol"""
+    import socketserver
+    
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            lock = threading.Lock()
+            
+            def write_reply(reply):
+                with lock:
+                    try:
+                        self.wfile.write(frame_reply(reply))
+                        self.wfile.flush()
+                    except OSError:
+                        pass  # Client went away; the job result is dropped
+            
+            futures = serve_lines(self.rfile, write_reply, scheduler)
+            # Keep the connection open until this client's jobs are answered
+            for future in futures:
+                future.result()
+    
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+    
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    with Server(socket_path, JobHandler) as server:
+        print(f"Worker listening on {socket_path}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
+
+def run_worker(args):
+    """Entry point for `upscale_script.py --worker [--socket PATH] [--concurrency N]`"""
+    import argparse
+    parser = argparse.ArgumentParser(prog='upscale_script.py --worker')
+    parser.add_argument('--socket', help='Unix socket path (default: read jobs from stdin)')
+    parser.add_argument('--concurrency', type=int, default=2, help='Jobs to run at once')
+    parser.add_argument('--max-units', type=float, default=2000,
+                        help='Compute units (output megapixels x model weight) allowed in flight at once')
+    parser.add_argument('--model-memory-mb', type=int, help='Memory budget for loaded models')
+    parser.add_argument('--preload', default='', help='Comma-separated MODELS keys to load at startup')
+    parser.add_argument('--batch-window-ms', type=float, default=0,
+                        help='Batch untiled EDSR (and preview FSRCNN) inference across jobs within this window (0 = off)')
+    parser.add_argument('--max-batch', type=int, default=8, help='Largest cross-job inference batch')
+    parser.add_argument('--cache-dir', help='Directory for the result cache (default: UPSCALE_CACHE_DIR, else off)')
+    parser.add_argument('--cache-mb', type=int, default=int(os.environ.get('UPSCALE_CACHE_MB', 2048)),
+                        help='Size limit for the result cache')
+    parser.add_argument('--realesrgan-path', help='Real-ESRGAN executable (default: REALESRGAN_PATH)')
+    parser.add_argument('--realesrgan-window-ms', type=float, default=0,
+                        help='Batch Real-ESRGAN jobs arriving within this window into one run (0 = off)')
+    parser.add_argument('--realesrgan-max-batch', type=int, default=8, help='Largest Real-ESRGAN batch')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus-style histograms on this port')
+    parser.add_argument('--tile-memory-mb', type=int,
+                        help='Inference memory cap for tiling (default: UPSCALE_TILE_MEMORY_MB, else 1024)')
+    parser.add_argument('--tile-cache-mb', type=int, default=0,
+                        help='Keep upscaled EDSR tiles in memory for reuse across jobs (0 = off)')
+    parser.add_argument('--tier-precision', default='',
+                        help='Default inference precision per tier, e.g. free=int8,pro=fp16 (others fp32)')
+    opts = parser.parse_args(args)
+    
+    global INFERENCE_BATCHER, RESULT_CACHE, REALESRGAN_BACKEND, STAGE_HISTOGRAMS, JOB_SCHEDULER, TILE_CACHE
+    for item in filter(None, (item.strip() for item in opts.tier_precision.split(','))):
+        tier, _, precision = item.partition('=')
+        if tier not in TIERS or precision not in INFERENCE_PRECISIONS:
+            parser.error(f"bad --tier-precision entry: {item}")
+        TIER_PRECISION[tier] = precision
+    if opts.metrics_port:
+        STAGE_HISTOGRAMS = StageHistograms()
+        serve_metrics(opts.metrics_port)
+    REALESRGAN_BACKEND = RealEsrganBackend(opts.realesrgan_path, REALESRGAN_BACKEND.timeout,
+                                           opts.realesrgan_window_ms, max(1, opts.realesrgan_max_batch))
+    if opts.cache_dir:
+        RESULT_CACHE = ResultCache(opts.cache_dir, opts.cache_mb)
+    elif RESULT_CACHE is not None:
+        RESULT_CACHE.max_bytes = opts.cache_mb * 1024 * 1024
+    if opts.batch_window_ms > 0:
+        INFERENCE_BATCHER = InferenceBatcher(opts.batch_window_ms, max(1, opts.max_batch))
+    
+    if opts.tile_memory_mb is not None:
+        TILE_PROFILES.memory_cap_mb = opts.tile_memory_mb
+    if opts.tile_cache_mb > 0:
+        TILE_CACHE = TileCache(opts.tile_cache_mb)
+    if opts.model_memory_mb is not None:
+        MODEL_REGISTRY.memory_budget = opts.model_memory_mb * 1024 * 1024
+    MODEL_REGISTRY.preload([key.strip() for key in opts.preload.split(',') if key.strip()])
+    
+    concurrency = max(1, opts.concurrency)
+    # Turn SIGTERM into a normal exit so the socket file gets cleaned up
+    import signal
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Worker started (concurrency: {concurrency}, max units: {opts.max_units:g})", file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        JOB_SCHEDULER = JobScheduler(executor, concurrency, opts.max_units)
+        try:
+            if opts.socket:
+                serve_socket(opts.socket, JOB_SCHEDULER)
+            else:
+                serve_stdin(JOB_SCHEDULER)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+# ============== BULK MODE ==============
+# Offline catalogue runs: `upscale_script.py --bulk manifest.jsonl` takes worker-style job
+# records ({"id"?, "input", "output", "mode", "options"}, one per line) and runs them on a
+# process pool whose processes keep their models loaded between items. Each finished item
+# is appended to the results log straight away, so a restarted run skips items that already
+# succeeded (and whose output is still there) and retries the rest.
+
+def _init_bulk_process(preload, cv_thread_count):
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C is handled by the parent
+    # One OpenCV thread per process by default: the pool is the parallelism
+    cv2.setNumThreads(cv_thread_count)
+    MODEL_REGISTRY.preload(preload)
+
+def _run_bulk_item(job):
+    """handle_job in a pool process, plus its wall-clock time"""
+    start = time.perf_counter()
+    reply = handle_job(job)
+    reply.pop('payload', None)  # Manifest jobs write files; an outputFormat job's bytes have nowhere to go
+    return {**reply, "elapsedMs": round((time.perf_counter() - start) * 1000, 1)}
+
+def completed_bulk_items(results_path):
+    """Ids logged with status "ok" in an existing results log"""
+    done = set()
+    try:
+        with open(results_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Last line of a run that was killed mid-write
+                if isinstance(entry, dict) and entry.get('status') == 'ok':
+                    done.add(entry.get('id'))
+    except OSError:
+        pass
+    return done
+
+def run_bulk(args):
+    """Entry point for `upscale_script.py --bulk MANIFEST [--results PATH] [--processes N]`"""
+    import argparse
+    parser = argparse.ArgumentParser(prog='upscale_script.py --bulk')
+    parser.add_argument('manifest', help='JSONL file of {"input", "output", "mode", "options"} records')
+    parser.add_argument('--results', help='JSONL results log, appended to (default: <manifest>.results.jsonl)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='Pool processes')
+    parser.add_argument('--preload', default='', help='Comma-separated MODELS keys each process loads at startup')
+    parser.add_argument('--cv-threads', type=int, default=1, help='OpenCV threads per process')
+    opts = parser.parse_args(args)
+    
+    results_path = opts.results or opts.manifest + '.results.jsonl'
+    done = completed_bulk_items(results_path)
+    processes = max(1, opts.processes)
+    preload = [key.strip() for key in opts.preload.split(',') if key.strip()]
+    counts = {"ok": 0, "error": 0, "skipped": 0}
+    pending = {}
+    start = time.perf_counter()
+    
+    pool = ProcessPoolExecutor(max_workers=processes, initializer=_init_bulk_process,
+                               initargs=(preload, opts.cv_threads))
+    try:
+        with open(opts.manifest) as manifest, open(results_path, 'a') as log:
+            def log_entry(entry):
+                counts[entry['status']] += 1
+                log.write(json.dumps(entry) + '\n')
+                log.flush()
+                print(f"[{sum(counts.values())}] {entry['id']}: {entry['status']}", file=sys.stderr)
+        
+            def collect(limit):
+                """Log finished items until no more than `limit` are outstanding"""
+                while len(pending) > limit:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        job = pending.pop(future)
+                        try:
+                            reply = future.result()
+                        except Exception as e:  # The pool process died
+                            reply = {"status": "error", "error": str(e)}
+                        log_entry({**reply, "id": job['id'], "input": job.get('input'), "output": job.get('output')})
+        
+            print(f"Bulk run: {processes} process(es), {len(done)} item(s) already done", file=sys.stderr)
+            for line_number, line in enumerate(manifest, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    job = json.loads(line)
+                except ValueError as e:
+                    log_entry({"id": f"line {line_number}", "status": "error", "error": f"Invalid JSON: {str(e)}"})
+                    continue
+                if not isinstance(job, dict):
+                    log_entry({"id": f"line {line_number}", "status": "error", "error": "Job must be a JSON object"})
+                    continue
+                # Without an explicit id an item is known by its output path
+                job['id'] = job.get('id') or job.get('output') or f"line {line_number}"
+                if job['id'] in done and os.path.exists(job.get('output', '')):
+                    counts['skipped'] += 1
+                    continue
+                pending[pool.submit(_run_bulk_item, job)] = job
+                collect(processes * 2)  # Keep the pool busy without reading the whole manifest ahead
+            collect(0)
+    except KeyboardInterrupt:
+        # Logged items stay done; whatever was in flight runs again next time
+        pool.shutdown(wait=False, cancel_futures=True)
+        print("Interrupted: rerun the same command to resume", file=sys.stderr)
+        return 130
+    pool.shutdown()
+    
+    elapsed = time.perf_counter() - start
+    summary = {**counts, "elapsedMs": round(elapsed * 1000, 1),
+               "itemsPerSecond": round(counts['ok'] / elapsed, 2) if elapsed else None, "results": results_path}
+    print(json.dumps(summary))
+    return 1 if counts['error'] else 0
+
+def run_profiler(keys, key_filter, measure, profiles_store, verbs):
+    """Shared body of --autotune and --profile-inference; returns the exit status
+    
+    Runs measure(key) (which saves into profiles_store) for each key, by default every
+    MODELS key present that key_filter accepts, and prints the profiles as one JSON object.
+    verbs is the (infinitive, gerund) pair for the messages, e.g. ('tune', 'Tuning').
+    """
+    keys = keys or [key for key in MODELS if key_filter(key) and get_model_path(key)[0]]
+    if not keys:
+        print(f"Error: No models found to {verbs[0]}", file=sys.stderr)
+        return 1
+    profiles = {}
+    try:
+        for key in keys:
+            print(f"{verbs[1]} {key}...", file=sys.stderr)
+            profiles[key] = measure(key)
+    except ProcessingError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    print(json.dumps(profiles))
+    print(f"Saved to {profiles_store.path}", file=sys.stderr)
+    return 0
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == '--worker':
+        return run_worker(argv[2:])
+    if len(argv) > 1 and argv[1] == '--bulk':
+        return run_bulk(argv[2:])
+    if len(argv) > 1 and argv[1] == '--stdio':
+        return run_stdio(argv[2:])
+    if len(argv) > 1 and argv[1] == '--autotune':
+        # Tunes the given MODELS keys (default: the tiled EDSR models present) and prints the profiles
+        return run_profiler(argv[2:], lambda key: key.startswith('edsr_'), autotune_tiles, TILE_PROFILES,
+                            ('tune', 'Tuning'))
+    if len(argv) > 1 and argv[1] == '--profile-inference':
+        # Measures the given MODELS keys (default: every model present) and prints the profiles
+        return run_profiler(argv[2:], lambda key: True, profile_inference, INFERENCE_PROFILES,
+                            ('profile', 'Profiling'))
+    if len(argv) > 2 and argv[1] == '--probe':
+        # One JSON list entry per path: {"path", "width", "height", "channels", "format"} or {"path", "error"}
+        print(json.dumps(probe_images(argv[2:])))
+        return 0
+    
+    if len(argv) < 4:
+        print("Usage: upscale_script.py <input> <output> <upscale|resize|resize-batch|video> [options_json]", file=sys.stderr)
+        print("       upscale_script.py --probe <path> [<path> ...]", file=sys.stderr)
+        print("       upscale_script.py --autotune [<model key> ...]", file=sys.stderr)
+        print("       upscale_script.py --profile-inference [<model key> ...]", file=sys.stderr)
+        print("       upscale_script.py --bulk <manifest.jsonl> [--results PATH] [--processes N]", file=sys.stderr)
+        print("       upscale_script.py --stdio <upscale|resize> <format> [options_json] < input", file=sys.stderr)
+        print("       upscale_script.py --worker [--socket PATH] [--concurrency N] [--preload KEYS]", file=sys.stderr)
+        return 1
+    
+    input_path = argv[1]
+    output_path = argv[2]
+    mode = argv[3]  # 'upscale', 'resize', 'video' or 'resize-batch' (output is then a directory)
+    
+    try:
+        options = json.loads(argv[4]) if len(argv) > 4 else {}
+        # Interim replies (a progressive upscale's preview) come out as JSON lines ahead of the result
+        result = run_job(input_path, output_path, mode, options,
+                         on_event=lambda status, payload: print(json.dumps({"status": status, **payload}), flush=True))
+        print(json.dumps(with_peak_rss(result)))
+        print("Done", file=sys.stderr)
+    except Exception as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    return 0
 
-except Exception as e:
-    print(str(e), file=sys.stderr)
-    sys.exit(1)
\ No newline at end of file
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))